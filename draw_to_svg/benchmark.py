@@ -0,0 +1,109 @@
+#! /usr/bin/env python3
+
+"""benchmark.py
+
+Converts Draw files with different settings, reporting the output size and time taken for each.
+With --memory, converts a generated Draw file with one long path instead, reporting the peak
+memory allocated.
+
+Usage:
+        python3 draw_to_svg/benchmark.py <draw files or directories>
+        python3 draw_to_svg/benchmark.py --memory [<points>]
+"""
+
+from pathlib import Path
+import os
+import random
+import struct
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import draw_to_svg as ds
+
+# The settings to compare, as (name, configuration values)
+image_format_settings = [
+    ("png",           { "image_format": "png" }),
+    ("webp-lossless", { "image_format": "webp-lossless" }),
+    ("webp",          { "image_format": "webp" }),
+]
+
+def find_draw_files(paths):
+    for path in paths:
+        path = Path(path)
+        if path.is_dir():
+            for p in sorted(path.rglob("*")):
+                if p.suffix.lower() == ".draw":
+                    yield p
+        else:
+            yield path
+
+def benchmark_images(draw_files, outdir):
+    print("{0:<32} {1:<14} {2:>10} {3:>10} {4:>12} {5:>10}".format("File", "Format", "Images", "SVG bytes", "Image bytes", "Encode s"))
+    totals = {}
+    for draw_file in draw_files:
+        for name, settings in image_format_settings:
+            for key, value in settings.items():
+                setattr(ds.convertor.config, key, value)
+
+            outfile = os.path.join(outdir, "out.svg")
+            ds.convertor.convert_to_svg(str(draw_file), outfile)
+            svg_bytes = os.path.getsize(outfile)
+
+            print("{0:<32} {1:<14} {2:>10} {3:>10} {4:>12} {5:>10.3f}".format(
+                draw_file.name[-32:], name, ds.convertor.image_count, svg_bytes,
+                ds.convertor.image_bytes, ds.convertor.image_encode_time))
+
+            total = totals.setdefault(name, [0, 0, 0])
+            total[0] += svg_bytes
+            total[1] += ds.convertor.image_bytes
+            total[2] += ds.convertor.image_encode_time
+
+    print()
+    for name, (svg_bytes, image_bytes, encode_time) in totals.items():
+        print("{0:<32} {1:<14} {2:>10} {3:>10} {4:>12} {5:>10.3f}".format("Total", name, "", svg_bytes, image_bytes, encode_time))
+
+def write_long_path_draw_file(filename, point_count):
+    """Writes a Draw file holding one path object, a random walk of 'point_count' points"""
+    page = (0, 0, 595*640, 842*640)       # A4, in Draw units
+    rng = random.Random(1)
+    (x, y) = (page[2] // 2, page[3] // 2)
+    components = [struct.pack("<3i", 2, x, y)]                  # Move
+    for i in range(point_count - 1):
+        x = min(max(x + rng.randint(-640, 640), 0), page[2])
+        y = min(max(y + rng.randint(-640, 640), 0), page[3])
+        components.append(struct.pack("<3i", 8, x, y))          # Draw
+    components.append(struct.pack("<i", 0))                     # End
+
+    # Path with no fill, a black outline 1/2 point wide and no caps
+    body = struct.pack("<3I4B", 0xffffffff, 0, 320, 0, 0, 0, 0) + b"".join(components)
+    path = struct.pack("<2I4i", 2, 24 + len(body), *page) + body
+    header = b"Draw" + struct.pack("<2I", 201, 0) + b"benchmark   " + struct.pack("<4i", *page)
+    with open(filename, "wb") as f:
+        f.write(header + path)
+
+def benchmark_memory(point_count, outdir):
+    draw_file = os.path.join(outdir, "long_path.draw")
+    write_long_path_draw_file(draw_file, point_count)
+
+    tracemalloc.start()
+    start_time = time.perf_counter()
+    ds.convertor.convert_to_svg(draw_file, os.path.join(outdir, "out.svg"))
+    elapsed = time.perf_counter() - start_time
+    (current, peak) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print("{0:>10} {1:>14} {2:>10}".format("Points", "Peak MB", "Seconds"))
+    print("{0:>10} {1:>14.2f} {2:>10.3f}".format(point_count, peak / (1024 * 1024), elapsed))
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print(__doc__, file=sys.stderr)
+        sys.exit(1)
+
+    with tempfile.TemporaryDirectory() as outdir:
+        if sys.argv[1] == "--memory":
+            benchmark_memory(int(sys.argv[2]) if len(sys.argv) > 2 else 100000, outdir)
+        else:
+            benchmark_images(list(find_draw_files(sys.argv[1:])), outdir)
@@ -11,23 +11,40 @@ example file.
 Requirements:
 There is only one dependency required, the Python Image Library ('Pillow'):
         https://pillow.readthedocs.io/en/latest/installation.html
+NumPy is optional, if installed it's used to speed up converting paths with line caps.
 
 TobyLobster, 2023
 """
 
 from PIL import Image
 from PIL import ImageFont
+from PIL import features
 from pathlib import Path
 from configparser import ConfigParser
 import argparse
 import base64
+import bisect
+import collections
+import contextlib
 import io
+import json
 import math
+import mmap
 import os
 import re
 import struct
 import sys
+import tempfile
+import time
 import copy
+import hashlib
+import itertools
+
+# NumPy is optional, it speeds up placing caps on long curved paths
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 # Just for fun, use colour names where possible
 colour_names = {
@@ -217,9 +234,62 @@ def bezier(a, b, c, d, t):
     mt3 = mt2 * mt
     return a*mt3 + b*mt2*t*3 + c*mt*t2*3 + d*t3
 
+def bezier_segment_count(a, b, c, d, tolerance, max_segments=1000):
+    """Number of equal steps in t needed for straight lines to stay within 'tolerance' of the
+    cubic bezier curve, from the second differences of the control points (Wang's formula)"""
+    dd = max(math.hypot(a.x - 2*b.x + c.x, a.y - 2*b.y + c.y),
+             math.hypot(b.x - 2*c.x + d.x, b.y - 2*c.y + d.y))
+    n = math.ceil(math.sqrt(0.75 * dd / tolerance))
+    return min(max(n, 1), max_segments)
+
+def simplify_polyline(points, tolerance):
+    """Returns the points of a polyline, leaving out points while the line stays within
+    'tolerance' of the original (Ramer-Douglas-Peucker)"""
+    xs = [point.x for point in points]
+    ys = [point.y for point in points]
+    keep = [False] * len(points)
+    keep[0] = keep[-1] = True
+    spans = [(0, len(points) - 1)]
+    while spans:
+        (first, last) = spans.pop()
+        if last - first < 2:
+            continue
+
+        # Find the point furthest from the line segment between the ends of the span,
+        # comparing squared distances
+        (ax, ay) = (xs[first], ys[first])
+        dx = xs[last] - ax
+        dy = ys[last] - ay
+        length_squared = dx*dx + dy*dy
+        furthest = None
+        furthest_distance = tolerance * tolerance
+        for i in range(first + 1, last):
+            px = xs[i] - ax
+            py = ys[i] - ay
+            if length_squared > 0:
+                t = (px*dx + py*dy) / length_squared
+                if t < 0:
+                    t = 0
+                elif t > 1:
+                    t = 1
+                px -= t*dx
+                py -= t*dy
+            distance = px*px + py*py
+            if distance > furthest_distance:
+                furthest = i
+                furthest_distance = distance
+
+        if furthest != None:
+            keep[furthest] = True
+            spans.append((first, furthest))
+            spans.append((furthest, last))
+    return [point for (point, kept) in zip(points, keep) if kept]
+
 class Point:
     """Represents a 2D point"""
 
+    __slots__ = ("x", "y")
+
     def __init__(self, x=0, y=0):
         self.x = x
         self.y = y
@@ -237,15 +307,18 @@ class Point:
     def __iadd__(self, other):
         self.x += other.x
         self.y += other.y
+        return self
 
     def __isub__(self, other):
         self.x -= other.x
         self.y -= other.y
+        return self
 
     def __imul__(self, other):
         if isinstance(other, int) or isinstance(other, float):
             self.x *= other
             self.y *= other
+        return self
 
     def lerp(self, other, t):
         return Point(lerp(self.x, other.x, t), lerp(self.y, other.y, t))
@@ -321,6 +394,616 @@ class Mat:
         return "({0},{1},{2}\n{3},{4},{5}\n0, 0, 1)".format(self.a, self.c, self.e, self.b, self.d, self.f)
 
 
+class FlattenedPathMeasure:
+    """Finds positions along a path that has been approximated by straight line segments"""
+
+    def __init__(self, segment_starts, segment_finishes, segment_lengths, segment_ends):
+        self.segment_starts   = segment_starts      # (x, y) at the start of each segment
+        self.segment_finishes = segment_finishes    # (x, y) at the end of each segment
+        self.segment_lengths  = segment_lengths
+        self.segment_ends     = segment_ends        # Cumulative length at the end of each segment
+        self.length = float(segment_ends[-1]) if len(segment_ends) > 0 else 0
+        self.index = 0
+
+    def locate(self, distance):
+        """Returns the position and direction at 'distance' along the path, or None if that's
+        beyond the end. Distances must be located in increasing order."""
+
+        # Binary search for the first straight line segment that ends at or beyond this
+        # distance. The distance only ever increases, so the search starts from the segment
+        # found last time.
+        self.index = bisect.bisect_left(self.segment_ends, distance, self.index)
+        if self.index >= len(self.segment_ends):
+            return None
+
+        (x0, y0) = self.segment_starts[self.index]
+        (x1, y1) = self.segment_finishes[self.index]
+        length = self.segment_lengths[self.index]
+        if length <= epsilon:
+            return (Point(x0, y0), 0)
+
+        # find position within this segment
+        length_so_far = self.segment_ends[self.index - 1] if self.index > 0 else 0
+        ratio = (distance - length_so_far) / length
+        return (Point(lerp(x0, x1, ratio), lerp(y0, y1, ratio)), math.atan2(y1 - y0, x1 - x0))
+
+    def end(self):
+        """Returns the position and direction at the end of the path"""
+        (x0, y0) = self.segment_starts[-1]
+        (x1, y1) = self.segment_finishes[-1]
+        return (Point(float(x1), float(y1)), math.atan2(y1 - y0, x1 - x0))
+
+    def locate_all(self, distances):
+        """Returns the position and direction at each of 'distances' along the path, which
+        must be in increasing order. Distances at or beyond the end of the path give the end."""
+        if np == None or not isinstance(self.segment_ends, np.ndarray):
+            return [self.locate(distance) if distance < self.length else self.end() for distance in distances]
+
+        # As locate(), but for every distance at once
+        distances = np.asarray(distances, dtype=float)
+        index = np.minimum(np.searchsorted(self.segment_ends, distances, side="left"), len(self.segment_ends) - 1)
+        starts = self.segment_starts[index]
+        finishes = self.segment_finishes[index]
+        lengths = self.segment_lengths[index]
+        length_so_far = np.where(index > 0, self.segment_ends[index - 1], 0)
+        is_short = lengths <= epsilon
+        ratio = (distances - length_so_far) / np.where(is_short, 1, lengths)
+        ratio = ratio[:, np.newaxis]
+        positions = np.where(is_short[:, np.newaxis], starts, starts * (1-ratio) + finishes * ratio)
+        delta = finishes - starts
+        directions = np.where(is_short, 0, np.arctan2(delta[:, 1], delta[:, 0]))
+
+        result = [(Point(x, y), direction) for ((x, y), direction) in zip(positions.tolist(), directions.tolist())]
+        for i in np.flatnonzero(distances >= self.length).tolist():
+            result[i] = self.end()
+        return result
+
+
+class ArcLengthPathMeasure:
+    """Finds positions along a path of lines and cubic bezier curves by measuring the arc
+    length of the curves themselves, using Gauss-Legendre quadrature, and inverting it with
+    Newton's method"""
+
+    # Five point Gauss-Legendre quadrature nodes and weights, for the interval [0, 1]
+    gauss_nodes   = [0.5, 0.5 - 0.2692346550528416, 0.5 + 0.2692346550528416, 0.5 - 0.4530899229693320, 0.5 + 0.4530899229693320]
+    gauss_weights = [0.2844444444444444, 0.2393143352496833, 0.2393143352496833, 0.1184634425280945, 0.1184634425280945]
+    gauss_points  = list(zip(gauss_nodes, gauss_weights))
+
+    def __init__(self, points, tolerance=1e-6):
+        # Each piece of the path is a cubic curve (a line has its control points at its ends)
+        # with the coefficients of its derivative, and a table of parameter values with the
+        # cumulative length of the piece at each
+        self.pieces = []
+        self.piece_ends = []            # Cumulative length of the path at the end of each piece
+        self.tolerance = tolerance
+        self.length = 0
+
+        for i in range(len(points)):
+            (tag, point) = points[i]
+            if tag == "Draw":
+                start = points[i-1][1]
+                control_points = (start.x, start.y, start.x, start.y, point.x, point.y, point.x, point.y)
+                coefficients = None
+                length = start.dist(point)
+                table = ([0.0, 1.0], [0.0, length])
+            elif tag == "Bezier3":
+                control_points = (points[i-3][1].x, points[i-3][1].y,
+                                  points[i-2][1].x, points[i-2][1].y,
+                                  points[i-1][1].x, points[i-1][1].y,
+                                  point.x, point.y)
+                coefficients = ArcLengthPathMeasure.derivative_coefficients(control_points)
+                table = ([0.0], [0.0])
+                self.build_table(coefficients, 0.0, 1.0, self.integrate(coefficients, 0.0, 1.0), table, 0)
+                length = table[1][-1]
+            else:
+                continue
+
+            self.length += length
+            self.pieces.append((control_points, coefficients, table))
+            self.piece_ends.append(self.length)
+
+        self.index = 0
+
+    def derivative_coefficients(control_points):
+        """The derivative of the curve as a quadratic in t: (x0, x1, x2, y0, y1, y2)"""
+        (ax, ay, bx, by, cx, cy, dx, dy) = control_points
+        return (3 * (bx - ax), 6 * (cx - 2 * bx + ax), 3 * (dx - 3 * cx + 3 * bx - ax),
+                3 * (by - ay), 6 * (cy - 2 * by + ay), 3 * (dy - 3 * cy + 3 * by - ay))
+
+    def derivative(control_points, t):
+        (x0, x1, x2, y0, y1, y2) = ArcLengthPathMeasure.derivative_coefficients(control_points)
+        return (x0 + t * (x1 + t * x2), y0 + t * (y1 + t * y2))
+
+    def integrate(self, coefficients, t0, t1):
+        """Arc length of the curve between parameters t0 and t1"""
+        (x0, x1, x2, y0, y1, y2) = coefficients
+        dt = t1 - t0
+        total = 0
+        for node, weight in ArcLengthPathMeasure.gauss_points:
+            t = t0 + dt * node
+            total += weight * math.hypot(x0 + t * (x1 + t * x2), y0 + t * (y1 + t * y2))
+        return total * dt
+
+    def build_table(self, coefficients, t0, t1, length, table, depth):
+        # Subdivide until the quadrature is accurate on each interval, recording the parameter
+        # and cumulative length at the end of each interval
+        tm = (t0 + t1) / 2
+        left = self.integrate(coefficients, t0, tm)
+        right = self.integrate(coefficients, tm, t1)
+        if depth < 12 and abs(left + right - length) > self.tolerance * max(1, length):
+            self.build_table(coefficients, t0, tm, left, table, depth + 1)
+            self.build_table(coefficients, tm, t1, right, table, depth + 1)
+        else:
+            table[0].append(t1)
+            table[1].append(table[1][-1] + left + right)
+
+    def point(control_points, t):
+        (ax, ay, bx, by, cx, cy, dx, dy) = control_points
+        t2 = t * t
+        t3 = t2 * t
+        mt = 1-t
+        mt2 = mt * mt
+        mt3 = mt2 * mt
+        return Point(ax*mt3 + bx*mt2*t*3 + cx*mt*t2*3 + dx*t3,
+                     ay*mt3 + by*mt2*t*3 + cy*mt*t2*3 + dy*t3)
+
+    def direction(control_points, t):
+        (x, y) = ArcLengthPathMeasure.derivative(control_points, t)
+        if abs(x) < epsilon and abs(y) < epsilon:
+            # No tangent at a cusp (or a degenerate line), so use the overall direction
+            (ax, ay, bx, by, cx, cy, dx, dy) = control_points
+            (x, y) = (dx - ax, dy - ay)
+        return math.atan2(y, x)
+
+    def parameter_at(self, coefficients, table, distance):
+        """Find the parameter t of the piece at 'distance' along it"""
+
+        # Find the interval of the table, then use Newton's method within it. The interval is
+        # narrowed as we go, and used to bisect instead if Newton's method steps outside it.
+        (ts, lengths) = table
+        k = bisect.bisect_left(lengths, distance)
+        k = min(max(k, 1), len(ts) - 1)
+        start = ts[k - 1]
+        (lo, hi) = (start, ts[k])
+        if lengths[k] - lengths[k - 1] <= epsilon:
+            return lo
+
+        target = distance - lengths[k - 1]
+        t = lo + (hi - lo) * target / (lengths[k] - lengths[k - 1])
+        for i in range(20):
+            error = self.integrate(coefficients, start, t) - target
+            if abs(error) < self.tolerance:
+                break
+            if error > 0:
+                hi = t
+            else:
+                lo = t
+            (x0, x1, x2, y0, y1, y2) = coefficients
+            speed = math.hypot(x0 + t * (x1 + t * x2), y0 + t * (y1 + t * y2))
+            if speed > epsilon:
+                t -= error / speed
+            if not (lo < t < hi):
+                t = (lo + hi) / 2
+        return t
+
+    def locate(self, distance):
+        """Returns the position and direction at 'distance' along the path, or None if that's
+        beyond the end. Distances must be located in increasing order."""
+        self.index = bisect.bisect_left(self.piece_ends, distance, self.index)
+        if self.index >= len(self.pieces):
+            return None
+
+        (control_points, coefficients, table) = self.pieces[self.index]
+        length_so_far = self.piece_ends[self.index - 1] if self.index > 0 else 0
+        piece_length = table[1][-1]
+        if piece_length <= epsilon:
+            return (Point(control_points[0], control_points[1]), 0)
+
+        if coefficients:
+            t = self.parameter_at(coefficients, table, distance - length_so_far)
+        else:
+            t = (distance - length_so_far) / piece_length
+        return (ArcLengthPathMeasure.point(control_points, t), ArcLengthPathMeasure.direction(control_points, t))
+
+    def locate_all(self, distances):
+        """Returns the position and direction at each of 'distances' along the path, which
+        must be in increasing order. Distances at or beyond the end of the path give the end."""
+        return [self.locate(distance) if distance < self.length else self.end() for distance in distances]
+
+    def end(self):
+        """Returns the position and direction at the end of the path"""
+        (control_points, coefficients, table) = self.pieces[-1]
+        return (Point(control_points[6], control_points[7]), ArcLengthPathMeasure.direction(control_points, 1))
+
+
+class PathDataEncoder:
+    """Writes SVG path data compactly: choosing the shorter of absolute or relative coordinates
+    for each command, leaving out repeated command letters and spaces before minus signs, and
+    trimming redundant zeros from numbers. Coordinates are rounded to 'precision' decimal
+    places first, so relative coordinates don't accumulate errors."""
+
+    def __init__(self, precision=4):
+        self.precision = precision
+        self.scale = 10 ** precision
+        self.command = None             # The command that numbers without a command letter would continue
+        self.current = (0, 0)           # Current point, in units of 10**-precision
+        self.subpath_start = (0, 0)
+        self.pending_move = None        # Moves are only output when something is drawn from them
+
+    def units(self, value):
+        # Round as formatting to 'precision' decimal places does, then scale to an integer
+        return round(round(value, self.precision) * self.scale)
+
+    def number(self, n):
+        sign = "-" if n < 0 else ""
+        (whole, fraction) = divmod(abs(n), self.scale)
+        if fraction == 0:
+            return sign + str(whole)
+        # Digits after the decimal point, without trailing zeros (or a leading zero before it)
+        fraction = str(fraction + self.scale)[1:].rstrip("0")
+        return sign + (str(whole) if whole else "") + "." + fraction
+
+    def command_text(self, letter, numbers):
+        """Returns the text of a command"""
+        # No separator is needed before a minus sign
+        text = " ".join([self.number(n) for n in numbers]).replace(" -", "-")
+        if letter != self.command:
+            return letter + text
+        if text.startswith("-"):
+            return text
+        return " " + text
+
+    def emit(self, candidates, point):
+        """Outputs the shortest of the candidate (letter, numbers) commands, all of which leave
+        the current point at 'point'"""
+        (text, letter) = min(((self.command_text(letter, numbers), letter) for (letter, numbers) in candidates), key=lambda c: len(c[0]))
+        self.command = { "M": "L", "m": "l" }.get(letter, letter)
+        self.current = point
+        return text
+
+    def flush_move(self):
+        if self.pending_move == None:
+            return ""
+        (x, y) = self.pending_move
+        (cx, cy) = self.current
+        self.pending_move = None
+        self.subpath_start = (x, y)
+        return self.emit([("M", (x, y)), ("m", (x - cx, y - cy))], (x, y))
+
+    def move(self, point):
+        # Only the last of several moves in a row matters
+        self.pending_move = (self.units(point.x), self.units(point.y))
+        return ""
+
+    def line(self, point):
+        text = self.flush_move()
+        (x, y) = (self.units(point.x), self.units(point.y))
+        (cx, cy) = self.current
+        if y == cy:
+            candidates = [("H", (x,)), ("h", (x - cx,))]
+        elif x == cx:
+            candidates = [("V", (y,)), ("v", (y - cy,))]
+        else:
+            candidates = [("L", (x, y)), ("l", (x - cx, y - cy))]
+        return text + self.emit(candidates, (x, y))
+
+    def curve(self, b, c, d):
+        text = self.flush_move()
+        points = [(self.units(p.x), self.units(p.y)) for p in (b, c, d)]
+        (cx, cy) = self.current
+        absolute = [n for p in points for n in p]
+        relative = [n for (x, y) in points for n in (x - cx, y - cy)]
+        return text + self.emit([("C", absolute), ("c", relative)], points[-1])
+
+    def close(self):
+        text = self.flush_move() + "z"
+        self.command = None
+        self.current = self.subpath_start
+        return text
+
+    def finish(self):
+        """Returns any remaining output at the end of the path"""
+        return self.flush_move()
+
+
+class FontMetrics:
+    """Measures text in a font from the advance of each character and the kerning between
+    each pair of characters, found from the font as they are first needed. This gives the same
+    lengths as laying out the whole text with the font, without doing so each time."""
+
+    def __init__(self, font):
+        self.font = font
+        self.advances = {}
+        self.kerning = {}
+
+        # Complex text layout can do more than kerning (e.g. ligatures), so needs the whole text
+        self.basic_layout = (font.layout_engine == ImageFont.Layout.BASIC)
+
+    def getlength(self, text):
+        """Returns the length of 'text' in pixels, as the font's getlength() does"""
+        if not self.basic_layout:
+            return self.font.getlength(text)
+        return self.prefix_lengths(text)[-1]
+
+    def prefix_lengths(self, text):
+        """Returns the length of each prefix of 'text' in pixels, from empty to all of it, or
+        None if they can't be found from the advances and kerning"""
+        if not self.basic_layout:
+            return None
+        if isinstance(text, (bytes, bytearray)):
+            text = text.decode("latin-1")
+
+        advances = self.advances
+        kerning = self.kerning
+        length = 0
+        lengths = [0]
+        previous = None
+        for char in text:
+            advance = advances.get(char)
+            if advance == None:
+                advance = advances[char] = self.font.getlength(char)
+            length += advance
+            if previous != None:
+                pair = previous + char
+                kern = kerning.get(pair)
+                if kern == None:
+                    kern = kerning[pair] = self.font.getlength(pair) - advances[previous] - advance
+                length += kern
+            lengths.append(length)
+            previous = char
+        return lengths
+
+
+class FontCache:
+    """A bounded cache of loaded fonts, shared by all conversions, least recently used first"""
+
+    def __init__(self, max_fonts=32):
+        self.max_fonts = max_fonts
+        self.fonts = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def load(self, filename, size, variation):
+        """Returns the metrics of the font from 'filename' at 'size' pixels, set to the named
+        'variation' if it has one, or None if it can't be loaded"""
+        key = (filename, size, variation)
+        if key in self.fonts:
+            self.hits += 1
+            self.fonts.move_to_end(key)
+            return self.fonts[key]
+
+        self.misses += 1
+        try:
+            font = ImageFont.truetype(filename, size)
+            if variation != None and variation.encode() in font.get_variation_names():
+                font.set_variation_by_name(variation)
+            font = FontMetrics(font)
+        except:
+            # Remember fonts that can't be loaded too, so they aren't tried again
+            font = None
+
+        self.fonts[key] = font
+        if len(self.fonts) > self.max_fonts:
+            self.fonts.popitem(last=False)
+        return font
+
+font_cache = FontCache()
+
+
+class FontIndex:
+    """Finds font files by name, from an index of the fonts in the standard font directories.
+    The index is built once and saved in a cache file. Later runs use it as long as the font
+    directories themselves haven't changed, and only look through them again if a font is looked
+    up that isn't in the index and hasn't been looked up before."""
+
+    version = 4         # Version of the saved index format
+    font_extensions = (".ttf", ".otf", ".ttc", ".otc", ".pfb")
+    regular_styles = ("regular", "book", "normal", "roman", "medium")
+
+    def __init__(self, cache_file=None):
+        if cache_file == None:
+            cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(Path.home(), ".cache")
+            cache_file = os.path.join(cache_home, "draw_to_svg", "font_index.json")
+        self.cache_file = cache_file
+        self.times = None                       # Modification time of each font directory
+        self.subdirectory_times = None          # ... and of each of their subdirectories
+        self.fonts = None
+        self.misses = None                      # Names of fonts known not to be in the index
+        self.checked = False                    # Whether this process has checked the subdirectories
+
+    def font_directories():
+        """The directories searched for fonts, as ImageFont.truetype() searches them"""
+        if sys.platform == "win32":
+            windir = os.environ.get("WINDIR")
+            return [os.path.join(windir, "fonts")] if windir else []
+        if sys.platform == "darwin":
+            return ["/Library/Fonts", "/System/Library/Fonts", os.path.expanduser("~/Library/Fonts")]
+        data_home = os.environ.get("XDG_DATA_HOME") or os.path.expanduser("~/.local/share")
+        data_dirs = os.environ.get("XDG_DATA_DIRS") or "/usr/local/share:/usr/share"
+        return [os.path.join(data_dir, "fonts") for data_dir in [data_home] + data_dirs.split(":")]
+
+    def top_level_times(directories):
+        """Returns the modification time of each directory that exists, not including
+        subdirectories"""
+        return { directory: os.stat(directory).st_mtime for directory in directories if os.path.isdir(directory) }
+
+    def directory_times(directories):
+        """Returns the modification time of each directory, including subdirectories"""
+        times = {}
+        for directory in directories:
+            for (root, dirs, files) in os.walk(directory):
+                times[root] = os.stat(root).st_mtime
+        return times
+
+    def search(name):
+        """Returns the file of the font called 'name' by searching the font directories, as
+        ImageFont.truetype() does, or None if there is no such font"""
+        if os.path.isfile(name):
+            return name
+        filename = os.path.basename(name)
+        has_extension = (os.path.splitext(filename)[1] != "")
+        other_extension = None
+        for directory in FontIndex.font_directories():
+            for (root, dirs, files) in os.walk(directory):
+                for walk_filename in files:
+                    if has_extension:
+                        if walk_filename == filename:
+                            return os.path.join(root, walk_filename)
+                    elif os.path.splitext(walk_filename)[0] == filename:
+                        # A name without extension prefers a .ttf file
+                        path = os.path.join(root, walk_filename)
+                        if os.path.splitext(walk_filename)[1] == ".ttf":
+                            return path
+                        if other_extension == None:
+                            other_extension = path
+        return other_extension
+
+    def scan(directories):
+        """Returns the index of the fonts in 'directories', which finds a font by its file name
+        with or without extension, matching exactly as ImageFont.truetype() does. Only the
+        names of the files are read."""
+        files = {}
+        stems = {}
+        for directory in directories:
+            for (root, dirs, walk_files) in os.walk(directory):
+                for filename in walk_files:
+                    path = os.path.join(root, filename)
+                    files.setdefault(filename, path)
+
+                    # Like ImageFont.truetype(), a name without extension prefers a .ttf file
+                    (stem, ext) = os.path.splitext(filename)
+                    if stem not in stems or (ext == ".ttf" and not stems[stem].endswith(".ttf")):
+                        stems[stem] = path
+        return { "files": files, "stems": stems, "names": None }
+
+    def scan_names(directories):
+        """Returns an index from lowercase font name to font file, to find a font by file name
+        (with or without extension), by family and style name (e.g. 'dejavu sans bold'), or by
+        family name alone for regular styles. This opens every font file, so is only done when
+        fonts are looked up by family name."""
+        names = {}
+        family_names = {}
+        for directory in directories:
+            for (root, dirs, walk_files) in os.walk(directory):
+                for filename in walk_files:
+                    (stem, ext) = os.path.splitext(filename)
+                    if ext.lower() not in FontIndex.font_extensions:
+                        continue
+                    path = os.path.join(root, filename)
+                    names.setdefault(filename.lower(), path)
+                    stem = stem.lower()
+                    if stem not in names or (ext == ".ttf" and not names[stem].endswith(".ttf")):
+                        names[stem] = path
+
+                    try:
+                        (family, style) = ImageFont.truetype(path, 10).getname()
+                    except:
+                        continue
+                    if family:
+                        family = family.lower()
+                        style = (style or "").lower()
+                        family_names.setdefault("{0} {1}".format(family, style).strip(), path)
+                        if style in FontIndex.regular_styles:
+                            family_names.setdefault(family, path)
+
+        # File names take precedence over family names
+        family_names.update(names)
+        return family_names
+
+    def load(self):
+        directories = FontIndex.font_directories()
+        try:
+            with open(self.cache_file, "r", encoding="utf-8") as f:
+                cached = json.load(f)
+            if cached["version"] == FontIndex.version and cached["directories"] == FontIndex.top_level_times(directories):
+                self.times = cached["directories"]
+                self.subdirectory_times = cached["subdirectories"]
+                self.fonts = cached["fonts"]
+                self.misses = set(cached["misses"])
+                message(2, "Using font index {0}".format(self.cache_file))
+                return
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+
+        self.rescan(directories)
+
+    def rescan(self, directories):
+        message(1, "Indexing fonts")
+        self.times = FontIndex.top_level_times(directories)
+        self.subdirectory_times = FontIndex.directory_times(directories)
+        self.fonts = FontIndex.scan(directories)
+        self.misses = set()
+        self.checked = True
+        self.save()
+
+    def check_for_changes(self):
+        """Rescans the font directories if anything in them (e.g. a subdirectory) has changed
+        since they were indexed. Returns True if they were rescanned. Each process only checks
+        once."""
+        if self.checked:
+            return False
+        self.checked = True
+        directories = FontIndex.font_directories()
+        if FontIndex.directory_times(directories) == self.subdirectory_times:
+            return False
+        self.rescan(directories)
+        return True
+
+    def save(self):
+        # Write to a temporary file and then replace the cache file with it, so conversions
+        # running at the same time never read a partly written index
+        try:
+            directory = os.path.dirname(self.cache_file)
+            os.makedirs(directory, exist_ok=True)
+            (handle, temp_file) = tempfile.mkstemp(dir=directory, prefix="font_index.", suffix=".tmp")
+            try:
+                with os.fdopen(handle, "w", encoding="utf-8") as f:
+                    json.dump({ "version": FontIndex.version, "directories": self.times, "subdirectories": self.subdirectory_times,
+                                "fonts": self.fonts, "misses": sorted(self.misses) }, f)
+                os.replace(temp_file, self.cache_file)
+            except:
+                os.unlink(temp_file)
+                raise
+        except OSError as e:
+            warning("Can't write font index {0}: {1}".format(self.cache_file, e))
+
+    def find_file(self, name):
+        """Returns the file of the font called 'name' from the index, as ImageFont.truetype()
+        would find it"""
+        filename = os.path.basename(name)
+        if os.path.splitext(filename)[1] != "":
+            return self.fonts["files"].get(filename)
+        return self.fonts["stems"].get(filename)
+
+    def find(self, name, family_names=False):
+        """Returns the file of the font called 'name', or None if there is no such font. This
+        finds the same file as ImageFont.truetype() would, unless 'family_names' is set, when
+        fonts it can't find are looked up ignoring case and by family name too."""
+        if os.path.isfile(name):
+            return name
+        if self.fonts == None:
+            self.load()
+
+        path = self.find_file(name)
+        if (path == None and name not in self.misses) or (path != None and not os.path.isfile(path)):
+            # A font that hasn't been looked up before, or has been removed since it was indexed
+            if self.check_for_changes():
+                path = self.find_file(name)
+            if path == None:
+                self.misses.add(name)
+                self.save()
+
+        if path == None and family_names:
+            if self.fonts["names"] == None:
+                message(1, "Indexing font family names")
+                self.fonts["names"] = FontIndex.scan_names(FontIndex.font_directories())
+                self.save()
+            path = self.fonts["names"].get(name.lower())
+        return path
+
+font_index = FontIndex()
+
+
 class CoordinateConversion:
     """Functions to help conversion from Draw to SVG coordinate space"""
 
@@ -332,6 +1015,7 @@ class CoordinateConversion:
         self.spsy = spsy
 
         self.draw_to_svg_mat = Mat(spsx/dpsx, 0, 0, -spsy/dpsy, 0, spsy)
+        self.pixel_size = 1     # Length of one SVG pixel in the converted units
 
     def draw_to_svg_width(self, width):
         return width * self.spsx / self.dpsx
@@ -362,6 +1046,28 @@ class CoordinateConversion:
     def px_to_pt(v):
         return v * 0.75
 
+class DrawUnitConversion:
+    """Leaves coordinates in Draw units, for paths written inside a transform from Draw to SVG
+    coordinate space"""
+
+    def __init__(self, cc):
+        self.pixel_size = cc.dpsx / cc.spsx
+        mat = cc.draw_to_svg_mat
+
+        # The transform from Draw to SVG coordinates, and its inverse
+        self.draw_to_svg_transform = "matrix({0!r} 0 0 {1!r} 0 {2!r})".format(mat.a, mat.d, mat.f)
+        self.svg_to_draw_transform = "matrix({0!r} 0 0 {1!r} 0 {2!r})".format(1 / mat.a, 1 / mat.d, -mat.f / mat.d)
+
+    def draw_to_svg_width(self, width):
+        return width
+
+    def draw_to_svg_point(self, point):
+        return Point(point.x, point.y)
+
+    def dp(self, f):
+        # Whole Draw units are accurate to well under a pixel
+        return str(round(f))
+
 class Convertor:
     """Converts a draw file into an SVG file"""
 
@@ -1570,6 +2276,8 @@ class Convertor:
     class Coords:
         """Stores an (x,y) integer position in Draw coordinates"""
 
+        __slots__ = ("x", "y")
+
         def __init__(self, x=0, y=0):
             self.x = x
             self.y = y
@@ -1587,6 +2295,8 @@ class Convertor:
 
 
     class ColourType:
+        __slots__ = ("reserved", "red", "green", "blue")
+
         def __init__(self, red = 0, green = 0, blue = 0):
             self.reserved = 0
             self.red      = Convertor.clamp(red, 0, 255)
@@ -1693,6 +2403,8 @@ class Convertor:
             self.baseline.read(f)
 
     class PathStyleType:
+        __slots__ = ("joinstyle", "endcapstyle", "startcapstyle", "winding", "dash", "reserved", "tricapwidth", "tricaplength")
+
         def __init__(self):
             self.joinstyle = 0
             self.endcapstyle = 0
@@ -1719,6 +2431,8 @@ class Convertor:
             self.tricaplength  = Convertor.read_uint(f, 1)
 
     class PathHeader:
+        __slots__ = ("fillcolour", "outlinecolour", "outlinewidth", "style")
+
         def __init__(self):
             self.fillcolour    = Convertor.ColourType()
             self.outlinecolour = Convertor.ColourType()
@@ -1832,6 +2546,25 @@ class Convertor:
             self.fonts_ini                      = None
             self.fit_border                     = None
             self.one_byte_types                 = False
+            self.crop_sprites                   = True
+            self.sprite_tile_rows               = 0
+            self.image_format                   = "png"     # "png", "webp-lossless" or "webp"
+            self.image_quality                  = 80        # Quality for lossy WebP and resampled JPEGs (0-100)
+            self.max_dpi                        = None      # Resample images displayed at more than this DPI
+            self.strip_jpeg_metadata            = False
+            self.dedupe_jpegs                   = True
+            self.flatness_tolerance             = 0.02      # Max distance in SVG pixels between a curve and its straight line approximation, or None for 50 lines per curve
+            self.cap_placement                  = "flatten" # "flatten" (straight line approximation) or "arc-length" (exact)
+            self.cap_output                     = "elements" # "elements" (one per cap), "symbols" (shared definitions) or "compound" (one path per path's caps)
+            self.cap_markers                    = False     # Use <marker>s for the caps of undashed paths
+            self.compact_paths                  = False     # Write path data as compactly as possible
+            self.path_precision                 = 4         # Decimal places in compact path data
+            self.coalesce_paths                 = False     # Write runs of paths that look the same as one <path>
+            self.simplify_tolerance             = None      # Remove points from paths while staying within this distance in pixels, or None to keep them all
+            self.draw_units                     = False     # Write paths in integer Draw units, inside one transform to SVG coordinates
+            self.font_index                     = True      # Find fonts for measuring text from a saved index of the font directories
+            self.font_family_names              = False     # Also find fonts for measuring text ignoring case and by family name
+            self.check_text_measurement         = False     # Warn if text measured from cached character widths differs from measuring it directly
 
     def __init__(self):
         # Calculate default 256 colour palette, stored in RGBA order
@@ -1861,6 +2594,7 @@ class Convertor:
         self.cc = None                          # A Coordinate Conversion object.
         self.options = None                     # One Draw options object per file. Optional.
         self.config = Convertor.Configure()     # Current tool configuration.
+        self.file_view = None                   # Memory mapped view of the input file
 
     # Utility functions (class methods) for reading from Draw file
     def eof(f, size):
@@ -1907,13 +2641,19 @@ class Convertor:
         return result
 
     def read_bytes_until_zero(f):
-        result = b''
+        # Read in blocks, leaving the file just after the zero byte
+        result = bytearray()
         while True:
-            raw_byte = f.read(1)
-            if raw_byte == b'\x00':
+            block = f.read(4096)
+            zero = block.find(b'\x00')
+            if zero >= 0:
+                result += block[:zero]
+                f.seek(zero + 1 - len(block), os.SEEK_CUR)
                 break
-            result += raw_byte
-        return result
+            if not block:
+                break
+            result += block
+        return bytes(result)
 
 
     def decode_bytes_to_utf8(text, font_name, alphabet):
@@ -2124,6 +2864,8 @@ class Convertor:
     class ObjectHeader:
         """Each object in the Draw file has this header"""
 
+        __slots__ = ("obj_type", "obj_length", "low", "high")
+
         def __init__(self):
             self.obj_type = 0
             self.obj_length = 0
@@ -2295,99 +3037,65 @@ class Convertor:
             pos.y += svg_fontsize_pixels.y
         return(text)
 
-    # Information about a single dash.
-    class DashEntry:
-        def __init__(self, is_start_cap, dist):
-            self.is_start_cap = is_start_cap
-            self.dist = dist
-
-        def __repr__(self):
-            return "'{0},{1}'".format(self.is_start_cap, self.dist)
-
-    def gather_simple_path_caps(self, fout, path, caps, svg_width, offset):
+    class DashPattern:
+        """A dash pattern, with the start and end of each dash within one repeat of it"""
+
+        __slots__ = ("dashes", "period", "phase")
+
+        def __init__(self, lengths, offset):
+            # Like SVG, an odd number of lengths is repeated to make an even number
+            if (len(lengths) & 1) != 0:
+                lengths = lengths * 2
+            ends = list(itertools.accumulate(lengths))
+            self.dashes = [(ends[i] - lengths[i], ends[i]) for i in range(0, len(lengths), 2)]
+            self.period = ends[-1] if ends else 0
+
+            # How far into the pattern the path starts
+            self.phase = offset % self.period if self.period > 0 else 0
+
+        def cap_distances(self, length):
+            """Returns the distances of the start and end of each dash along a path of 'length',
+            clipped to the path, as [start, end, start, end, ...]"""
+            repeats = int((length + self.phase) // self.period) + 1
+            if np != None:
+                # Every dash of every repeat of the pattern at once
+                origins = np.arange(repeats) * self.period - self.phase
+                dashes = np.array(self.dashes)
+                starts = (origins[:, np.newaxis] + dashes[:, 0]).ravel()
+                ends = (origins[:, np.newaxis] + dashes[:, 1]).ravel()
+                keep = ((ends > 0) | ((ends == starts) & (starts >= 0))) & (starts < length)
+                return np.column_stack((np.maximum(starts[keep], 0), np.minimum(ends[keep], length))).ravel()
+
+            distances = []
+            for i in range(repeats):
+                origin = i * self.period - self.phase
+                for (dash_start, dash_end) in self.dashes:
+                    (start, end) = (origin + dash_start, origin + dash_end)
+                    if (end > 0 or end == start >= 0) and start < length:
+                        distances += [max(start, 0), min(end, length)]
+            return distances
+
+    def gather_simple_path_caps(self, fout, path, dash_pattern, svg_width):
         output = ""
-        # Calculate total path length
-        total_path_length = 0
-        for segment in self.path_segments:
-            length = segment[0].dist(segment[1])
-            total_path_length += length
+        # Measure the path, either exactly or by approximating it with straight line segments
+        if self.config.cap_placement == "arc-length":
+            path_measure = ArcLengthPathMeasure(self.points)
+        else:
+            path_measure = FlattenedPathMeasure(*self.flatten_path())
+        total_path_length = path_measure.length
 
         # Essentially a zero length path, so don't try to work out caps
         if total_path_length < epsilon:
             return("")
 
-        if caps == None:
+        if dash_pattern == None:
             # One dash for the full length of the path
-            caps = [self.DashEntry(False, total_path_length)]
-
-        # If there are an odd number of caps, then add one to make it have the same number of start
-        # caps as end caps.
-        if (len(caps) & 1) != 0:
-            caps.append(self.DashEntry(True, total_path_length))
-
-        # Calculate positions and directions for caps
-        cap_info = []
-
-        # Move through the caps based on the initial 'offset'
-        cap_index = 0
-        current_cap_distance = offset
-        while current_cap_distance > caps[cap_index].dist:
-            current_cap_distance -= caps[cap_index].dist
-            cap_index = (cap_index + 1) % len(caps)
-
-        is_start_cap = not caps[cap_index].is_start_cap
-        initial_offset_is_not_a_dash_its_in_a_gap = not is_start_cap
-
-        done = False
-
-        while not done:
-            # Variables to record the position and direction of the current cap
-            cap_pos = None
-            cap_dir = None
-
-            # Find the position and direction at a distance 'current_cap_distance' along the path
-            #
-            # To do this we look through each straight line segment of the path, until we find the
-            # correct distance from the start of the path
-            #
-            # (TODO: make a more efficient, incremental approach rather than starting from the
-            # beginning of the path each time.)
-            length_so_far = 0
-            for segment in self.path_segments:
-                length = segment[0].dist(segment[1])
-
-                if current_cap_distance <= (length_so_far + length):
-                    if length > epsilon:
-                        # find position within this segment
-                        ratio = (current_cap_distance - length_so_far) / length
-                        cap_pos = segment[0].lerp(segment[1], ratio)
-                        cap_dir = math.atan2(segment[1].y - segment[0].y, segment[1].x - segment[0].x)
-                    else:
-                        cap_pos = segment[0]
-                        cap_dir = 0
-                    break
-
-                length_so_far += length
-
-            # Store the cap_pos and cap_dir
-            if not initial_offset_is_not_a_dash_its_in_a_gap:
-                if cap_pos != None:
-                        cap_info.append([cap_pos, cap_dir, is_start_cap, "Middle", cap_index])
-                else:
-                    if not is_start_cap:
-                        # draw final end cap
-                        cap_pos = segment[1]
-                        cap_dir = math.atan2(segment[1].y - segment[0].y, segment[1].x - segment[0].x)
-                        cap_info.append([cap_pos, cap_dir, False, "End", cap_index])
-                    done = True
-            initial_offset_is_not_a_dash_its_in_a_gap = False
-
-            # Move current distance along the path to the position of the current cap
-            current_cap_distance += caps[cap_index].dist
-            is_start_cap = caps[cap_index].is_start_cap
+            distances = [0, total_path_length]
+        else:
+            distances = dash_pattern.cap_distances(total_path_length)
 
-            # Move to next cap
-            cap_index = (cap_index + 1) % len(caps)
+        # Calculate positions and directions for caps, at the start and end of each dash
+        cap_info = [[cap_pos, cap_dir, (i & 1) == 0] for (i, (cap_pos, cap_dir)) in enumerate(path_measure.locate_all(distances))]
 
         # Caps data
         fill_caps = 'fill="{0}"'.format(self.colour_name(path.outlinecolour))
@@ -2395,6 +3103,11 @@ class Convertor:
         scale_x = svg_width * path.style.tricaplength / 16
         scale_y = svg_width * path.style.tricapwidth / 16
 
+        if self.config.cap_output == "symbols":
+            return self.write_cap_uses(path, cap_info, fill_caps, svg_width, scale_x, scale_y)
+        if self.config.cap_output == "compound":
+            return self.cap_path_data(path, cap_info, svg_width, scale_x, scale_y)
+
         for cap in cap_info:
             cap_angle   = math.degrees(cap[1])
 
@@ -2409,31 +3122,31 @@ class Convertor:
                     output += '<circle id="cap{0}_start_round" {1} stroke="none" r="{2}" cx="{3}" cy="{4}" />\n'.format(
                         self.cap_count,
                         fill_caps,
-                        self.dp(svg_width / 2),
-                        self.dp(cap[0].x),
-                        self.dp(cap[0].y))
+                        self.path_dp(svg_width / 2),
+                        self.path_dp(cap[0].x),
+                        self.path_dp(cap[0].y))
                     self.cap_count += 1
                 elif path.style.startcapstyle == 2:
                     # Output square start cap (0.02 is a small amount of overlap to avoid tiny gaps due to accuracy issues)
                     output += '<path id="cap{0}_start_square" {1} stroke="none" transform="translate({2} {3}) rotate({4}) scale({5} {6})" d="M-1 -1 L-1 1 L0.02 1 L0.02 -1 z" />\n'.format(
                         self.cap_count,
                         fill_caps,
-                        self.dp(cap[0].x),
-                        self.dp(cap[0].y),
+                        self.path_dp(cap[0].x),
+                        self.path_dp(cap[0].y),
                         self.dp(cap_angle),
-                        self.dp(svg_width / 2),
-                        self.dp(svg_width / 2))
+                        self.path_dp(svg_width / 2),
+                        self.path_dp(svg_width / 2))
                     self.cap_count += 1
                 elif path.style.startcapstyle == 3:
                     # Output triangle start cap (0.02 is a small amount of overlap to avoid tiny gaps due to accuracy issues)
                     output += '<path id="cap{0}_start_triangle" {1} stroke="none" transform="translate({2} {3}) rotate({4}) scale({5} {6})" d="M0.02 -1 L0.02 1 L-1 0 z" />\n'.format(
                         self.cap_count,
                         fill_caps,
-                        self.dp(cap[0].x),
-                        self.dp(cap[0].y),
+                        self.path_dp(cap[0].x),
+                        self.path_dp(cap[0].y),
                         self.dp(cap_angle),
-                        self.dp(scale_x),
-                        self.dp(scale_y))
+                        self.path_dp(scale_x),
+                        self.path_dp(scale_y))
                     self.cap_count += 1
             else:
                 # End Cap
@@ -2446,34 +3159,190 @@ class Convertor:
                     output += '<circle id="cap{0}_end_round" {1} stroke="none" r="{2}" cx="{3}" cy="{4}" />\n'.format(
                         self.cap_count,
                         fill_caps,
-                        self.dp(svg_width / 2),
-                        self.dp(cap[0].x),
-                        self.dp(cap[0].y))
+                        self.path_dp(svg_width / 2),
+                        self.path_dp(cap[0].x),
+                        self.path_dp(cap[0].y))
                     self.cap_count += 1
                 elif path.style.endcapstyle == 2:
                     # Output square end cap (0.02 is a small amount of overlap to avoid tiny gaps due to accuracy issues)
                     output += '<path id="cap{0}_end_square" {1} stroke="none" transform="translate({2} {3}) rotate({4}) scale({5} {6})" d="M-0.02 -1 L-0.02 1 L1 1 L1 -1 z" />\n'.format(
                         self.cap_count,
                         fill_caps,
-                        self.dp(cap[0].x),
-                        self.dp(cap[0].y),
+                        self.path_dp(cap[0].x),
+                        self.path_dp(cap[0].y),
                         self.dp(cap_angle),
-                        self.dp(svg_width / 2),
-                        self.dp(svg_width / 2))
+                        self.path_dp(svg_width / 2),
+                        self.path_dp(svg_width / 2))
                     self.cap_count += 1
                 elif path.style.endcapstyle == 3:
                     # Output triangle end cap (0.02 is a small amount of overlap to avoid tiny gaps due to accuracy issues)
                     output += '<path id="cap{0}_end_triangle" {1} stroke="none" transform="translate({2} {3}) rotate({4}) scale({5} {6})" d="M-0.02 -1 L1 0 L-0.02 1 z" />\n'.format(
                         self.cap_count,
                         fill_caps,
-                        self.dp(cap[0].x),
-                        self.dp(cap[0].y),
+                        self.path_dp(cap[0].x),
+                        self.path_dp(cap[0].y),
                         self.dp(cap_angle),
-                        self.dp(scale_x),
-                        self.dp(scale_y))
+                        self.path_dp(scale_x),
+                        self.path_dp(scale_y))
                     self.cap_count += 1
         return(output)
 
+    # Shapes of square and triangle caps for a line of half width one along the x axis, by
+    # (is start cap, cap style). 0.02 is a small amount of overlap to avoid tiny gaps due to
+    # accuracy issues.
+    cap_shapes = { (True,  2): [(-1, -1), (-1, 1), (0.02, 1), (0.02, -1)],
+                   (True,  3): [(0.02, -1), (0.02, 1), (-1, 0)],
+                   (False, 2): [(-0.02, -1), (-0.02, 1), (1, 1), (1, -1)],
+                   (False, 3): [(-0.02, -1), (1, 0), (-0.02, 1)] }
+
+    def cap_shape(self, is_start_cap, capstyle, svg_width, scale_x, scale_y):
+        """Returns the element name and attributes of a cap's shape, centred on the origin and
+        pointing along the x axis"""
+        if capstyle == 1:
+            return ("circle", 'r="{0}"'.format(self.path_dp(svg_width / 2)))
+        if capstyle == 2:
+            (scale_x, scale_y) = (svg_width / 2, svg_width / 2)
+        return ("path", 'transform="scale({0} {1})" d="M{2} z"'.format(
+            self.path_dp(scale_x),
+            self.path_dp(scale_y),
+            " L".join("{0:g} {1:g}".format(x, y) for (x, y) in Convertor.cap_shapes[(is_start_cap, capstyle)])))
+
+    def cap_symbol(self, is_start_cap, capstyle, svg_width, scale_x, scale_y):
+        """Returns the id of the definition of a cap's shape, and the <defs> to write for it if
+        it is new. Caps that look the same share a definition."""
+        key = self.cap_shape(is_start_cap, capstyle, svg_width, scale_x, scale_y)
+        cap_id = self.cap_defs.get(key)
+        if cap_id != None:
+            return (cap_id, "")
+
+        cap_id = "capdef{0}".format(len(self.cap_defs))
+        self.cap_defs[key] = cap_id
+        return (cap_id, '<defs><{0} id="{1}" {2} /></defs>\n'.format(key[0], cap_id, key[1]))
+
+    def cap_marker(self, is_start_cap, capstyle, fill_caps, svg_width, scale_x, scale_y):
+        """Returns the id of a <marker> drawing a cap, and the <defs> to write for it if it is
+        new. Markers are sized in user space, and turned to follow the path."""
+        (element, attributes) = self.cap_shape(is_start_cap, capstyle, svg_width, scale_x, scale_y)
+        key = (element, attributes, fill_caps)
+        marker_id = self.marker_defs.get(key)
+        if marker_id != None:
+            return (marker_id, "")
+
+        marker_id = "capmarker{0}".format(len(self.marker_defs))
+        self.marker_defs[key] = marker_id
+        return (marker_id, '<defs><marker id="{0}" markerUnits="userSpaceOnUse" orient="auto" overflow="visible"><{1} {2} stroke="none" {3} /></marker></defs>\n'.format(
+            marker_id, element, fill_caps, attributes))
+
+    def write_cap_markers(self, path, svg_width):
+        """Output the caps at the ends of the current simple path ('self.points') as markers. The
+        markers are drawn by an invisible path of two short lines, that leave the start of the
+        path and arrive at its end in the same directions as the path itself."""
+        # (The points may end with the move to the start of the next simple path)
+        points = [self.points[0][1]] + [point for (tag, point) in self.points[1:] if tag not in ("Move", "Close")]
+        (start, end) = (points[0], points[-1])
+        if all(point.dist(start) < epsilon for point in points):
+            # Essentially a zero length path, so no caps
+            return ""
+
+        # The direction at each end is towards the nearest control point that isn't at the end
+        leaving = next(point for point in points if point.dist(start) >= epsilon)
+        arriving = next(point for point in reversed(points) if point.dist(end) >= epsilon)
+
+        fill_caps = 'fill="{0}"'.format(self.colour_name(path.outlinecolour))
+        scale_x = svg_width * path.style.tricaplength / 16
+        scale_y = svg_width * path.style.tricapwidth / 16
+
+        output = ""
+        attributes = ""
+        for (is_start_cap, capstyle) in ((True, path.style.startcapstyle), (False, path.style.endcapstyle)):
+            if capstyle in (1, 2, 3):
+                (marker_id, defs) = self.cap_marker(is_start_cap, capstyle, fill_caps, svg_width, scale_x, scale_y)
+                output += defs
+                attributes += ' marker-{0}="url(#{1})"'.format("start" if is_start_cap else "end", marker_id)
+                self.cap_count += 1
+
+        output += '<path fill="none" stroke="none"{0} d="M{1} {2}L{3} {4}M{5} {6}L{7} {8}" />\n'.format(
+            attributes,
+            self.path_dp(start.x),
+            self.path_dp(start.y),
+            self.path_dp(leaving.x),
+            self.path_dp(leaving.y),
+            self.path_dp(arriving.x),
+            self.path_dp(arriving.y),
+            self.path_dp(end.x),
+            self.path_dp(end.y))
+        return output
+
+    def write_cap_uses(self, path, cap_info, fill_caps, svg_width, scale_x, scale_y):
+        """Output caps as instances of shared cap definitions"""
+        output = ""
+        for cap in cap_info:
+            capstyle = path.style.startcapstyle if cap[2] else path.style.endcapstyle
+            if capstyle not in (1, 2, 3):
+                continue
+
+            (cap_id, defs) = self.cap_symbol(cap[2], capstyle, svg_width, scale_x, scale_y)
+            output += defs
+            if capstyle == 1:
+                # Round caps don't need rotating
+                output += '<use xlink:href="#{0}" x="{1}" y="{2}" />\n'.format(
+                    cap_id,
+                    self.path_dp(cap[0].x),
+                    self.path_dp(cap[0].y))
+            else:
+                output += '<use xlink:href="#{0}" transform="translate({1} {2}) rotate({3})" />\n'.format(
+                    cap_id,
+                    self.path_dp(cap[0].x),
+                    self.path_dp(cap[0].y),
+                    self.dp(math.degrees(cap[1])))
+            self.cap_count += 1
+
+        if output == "":
+            return output
+        return '<g {0} stroke="none">\n{1}</g>\n'.format(fill_caps, output)
+
+    def cap_path_data(self, path, cap_info, svg_width, scale_x, scale_y):
+        """Returns the caps as path data, one subpath per cap, to be filled together. Every
+        subpath winds the same way, so overlapping caps don't cancel each other out."""
+        output = ""
+        for cap in cap_info:
+            capstyle = path.style.startcapstyle if cap[2] else path.style.endcapstyle
+            if capstyle == 1:
+                # A circle made of two arcs
+                r = svg_width / 2
+                output += "M{0} {1}A{2} {2} 0 1 1 {3} {1}A{2} {2} 0 1 1 {0} {1}Z\n".format(
+                    self.path_dp(cap[0].x - r),
+                    self.path_dp(cap[0].y),
+                    self.path_dp(r),
+                    self.path_dp(cap[0].x + r))
+            elif capstyle in (2, 3):
+                shape = Convertor.cap_shapes[(cap[2], capstyle)]
+                if capstyle == 2:
+                    (sx, sy) = (svg_width / 2, svg_width / 2)
+                else:
+                    (sx, sy) = (scale_x, scale_y)
+
+                # Scale, rotate and translate the shape into place
+                (c, s) = (math.cos(cap[1]), math.sin(cap[1]))
+                points = [(cap[0].x + c * x * sx - s * y * sy, cap[0].y + s * x * sx + c * y * sy) for (x, y) in shape]
+                if Convertor.signed_area(points) < 0:
+                    points.reverse()
+                output += "M" + "L".join("{0} {1}".format(self.path_dp(x), self.path_dp(y)) for (x, y) in points) + "Z\n"
+            else:
+                continue
+            self.cap_count += 1
+        return output
+
+    def signed_area(points):
+        """Twice the signed area of a polygon, positive when it winds the same way as the
+        arcs of round caps"""
+        area = 0
+        for i in range(len(points)):
+            (x0, y0) = points[i - 1]
+            (x1, y1) = points[i]
+            area += x0 * y1 - x1 * y0
+        return area
+
     def get_cap_desc(capstyle):
         capdescs = { 0: "0 (butt caps)",
                      1: "1 (round caps)",
@@ -2509,9 +3378,9 @@ class Convertor:
 
         if path.outlinewidth==0:
             # Thinnest lines = one pixel
-            svg_width = 1
+            svg_width = self.path_cc.pixel_size
         else:
-            svg_width = self.cc.draw_to_svg_width(path.outlinewidth)
+            svg_width = self.path_cc.draw_to_svg_width(path.outlinewidth)
 
 
         # Handle dash array
@@ -2520,55 +3389,121 @@ class Convertor:
         if path.style.dash:
             # Read dasharray
             offset = Convertor.read_int(fin)
-            offset = self.cc.draw_to_svg_width(offset)
+            offset = self.path_cc.draw_to_svg_width(offset)
             dash_count = Convertor.read_uint(fin)
 
-            if offset > 0:
-                dash_array_string += 'stroke-dashoffset="{0}" '.format(self.dp(offset))
+            if offset != 0:
+                dash_array_string += 'stroke-dashoffset="{0}" '.format(self.path_dp(offset))
 
             dash_array_string += 'style="stroke-dasharray:'
 
-            # Start the first dash at distance zero
-            is_start_cap = True
-            caps = []
+            dash_lengths = []
             for i in range(dash_count):
-                dash_offset = Convertor.read_uint(fin)
-                dash_offset = self.cc.draw_to_svg_width(dash_offset)
+                dash_length = Convertor.read_uint(fin)
+                dash_length = self.path_cc.draw_to_svg_width(dash_length)
 
-                is_start_cap = not is_start_cap
-                caps.append(self.DashEntry(is_start_cap, dash_offset))
-                dash_array_string += ' {0}'.format(self.dp(dash_offset))
+                dash_lengths.append(dash_length)
+                dash_array_string += ' {0}'.format(self.path_dp(dash_length))
             dash_array_string += '"'
+
+            # Work out where the dashes are in the pattern once for the whole path. (A pattern
+            # of zero length draws a solid line.)
+            dash_pattern = Convertor.DashPattern(dash_lengths, offset)
+            if dash_pattern.period <= 0:
+                dash_pattern = None
         else:
-            # Do this later when we know the length of the path
-            caps = None
+            # One dash for the full length of the path
+            dash_pattern = None
+
+        # Only paths with (non-butt) caps need flattening into straight line segments, to find
+        # where to draw the caps. Other paths are output directly from their control points.
+        needs_caps = (path.style.startcapstyle != 0) or (path.style.endcapstyle != 0)
+
+        # Caps at the ends of undashed paths can be drawn by markers, so they don't need
+        # flattening either
+        use_cap_markers = needs_caps and self.config.cap_markers and not path.style.dash
+
+        path_attributes = '{0} fill-rule="{1}" {2} stroke-width="{3}" stroke-linejoin="{4}" {5}'.format(
+            fill,
+            "nonzero" if (path.style.winding==0) else "evenodd",
+            stroke,
+            self.path_dp(svg_width),
+            "miter" if (path.style.joinstyle==0) else "round" if (path.style.joinstyle==1) else "bevel",
+            dash_array_string)
+
+        # A run of paths without caps that look the same can be written as one <path>. The dash
+        # pattern restarts at each subpath, so dashes are unaffected. Paths that are filled must
+        # not overlap the path so far, as the fill rule would then combine them, and one's fill
+        # would no longer be painted over the other's outline.
+        coalesce = self.config.coalesce_paths and not needs_caps and not self.config.show_bounding_boxes and not self.config.show_debug_index
+        bounding_box = (object_header.low.x, object_header.low.y, object_header.high.x, object_header.high.y)
+        if coalesce and (self.pending_path != None) and (self.pending_path[0] == path_attributes):
+            pending_box = self.pending_path[1]
+            if path.fillcolour.reserved == 0xff or not Convertor.boxes_overlap(bounding_box, pending_box):
+                # Continue the pending path
+                self.path_count += 1
+                self.coalesced_paths += 1
+                self.points = []
+                self.write_path_object_components(fin, fout, path, dash_pattern, svg_width, False, False)
+                self.pending_path = (path_attributes, (min(bounding_box[0], pending_box[0]), min(bounding_box[1], pending_box[1]),
+                                                       max(bounding_box[2], pending_box[2]), max(bounding_box[3], pending_box[3])))
+                return
+        self.end_pending_path(fout)
 
         # Group together lines with caps, or path segments
-        if (path.style.startcapstyle != 0) or (path.style.endcapstyle != 0):
+        if needs_caps:
             started_group = True
             fout.write('<g id="draw_path{0}">\n'.format(self.path_count))
             self.path_count += 1
+            path_header = '<path {0} d="'.format(path_attributes)
         else:
             started_group = False
-            fill = 'id="draw_path{0}" '.format(self.path_count) + fill
+            path_header = '<path id="draw_path{0}" {1} d="'.format(self.path_count, path_attributes)
             self.path_count += 1
 
         # Output multiple <paths>, each separated by a 'move' command.
         # The dash offset is reset between these path segments.
-        path_header = '<path {0} fill-rule="{1}" {2} stroke-width="{3}" stroke-linejoin="{4}" {5} d="'.format(
-            fill,
-            "nonzero" if (path.style.winding==0) else "evenodd",
-            stroke,
-            self.dp(svg_width),
-            "miter" if (path.style.joinstyle==0) else "round" if (path.style.joinstyle==1) else "bevel",
-            dash_array_string)
 
         # Output path(s)
         # Converts the path into straight line segments
         fout.write(path_header)
 
         self.points = []        # Remember points, useful for adding caps afterwards
-        self.path_segments = [] # Straight line segments approximating the path
+        self.path_encoder = PathDataEncoder(self.config.path_precision) if self.config.compact_paths else None
+        caps_output = self.write_path_object_components(fin, fout, path, dash_pattern, svg_width, needs_caps, use_cap_markers)
+
+        if coalesce:
+            # Leave the path open, for any following paths to be added to
+            self.pending_path = (path_attributes, bounding_box)
+            return
+
+        if self.path_encoder != None:
+            fout.write(self.path_encoder.finish())
+        fout.write('" />\n')  # End previous path
+        if caps_output != "":
+            if self.config.cap_output == "compound" and not use_cap_markers:
+                # All the caps of the path are one element
+                caps_output = '<path fill="{0}" fill-rule="nonzero" stroke="none" d="{1}" />\n'.format(
+                    self.colour_name(path.outlinecolour),
+                    caps_output.rstrip("\n"))
+            fout.write(caps_output)
+        if started_group:
+            fout.write('</g>\n')
+
+    def boxes_overlap(a, b):
+        return a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]
+
+    def end_pending_path(self, fout):
+        """Finish writing any path that following paths could have been added to"""
+        if self.pending_path == None:
+            return
+        if self.path_encoder != None:
+            fout.write(self.path_encoder.finish())
+        fout.write('" />\n')
+        self.pending_path = None
+
+    def write_path_object_components(self, fin, fout, path, dash_pattern, svg_width, needs_caps, use_cap_markers):
+        """Reads and writes the components of a path object, returning the output for its caps"""
         old_status = ""
         caps_output = ""
         while True:
@@ -2579,14 +3514,18 @@ class Convertor:
                 else:
                     move = None
 
+                if self.config.simplify_tolerance != None:
+                    self.simplify_path()
                 self.write_path_components(fout)
                 #fout.write('" />\n')  # End previous path
 
                 # Output caps for path
-                caps_output += self.gather_simple_path_caps(fout, path, caps, svg_width, offset)
+                if use_cap_markers:
+                    caps_output += self.write_cap_markers(path, svg_width)
+                elif needs_caps:
+                    caps_output += self.gather_simple_path_caps(fout, path, dash_pattern, svg_width)
                 if move != None:
                     self.points = [move]               # Last 'Move to' point remembered as start of next simple path
-                self.path_segments = []                # Straight line segments approximating the path
 
                 if status == "Moved":
                     # Start next simple path
@@ -2596,28 +3535,74 @@ class Convertor:
             if status == "Finished":
                 break
             old_status = status
+        return caps_output
 
-        fout.write('" />\n')  # End previous path
-        if caps_output != "":
-            fout.write(caps_output)
-        if started_group:
-            fout.write('</g>\n')
 
+    def simplify_path(self):
+        """Removes points from the current simple path ('self.points') that make little or no
+        difference to it: zero length lines and curves, and points of runs of straight lines
+        that stay within the tolerance without them (e.g. collinear points)"""
+        tolerance = max(self.config.simplify_tolerance * self.path_cc.pixel_size, epsilon)
+        points = []
+        i = 0
+        while i < len(self.points):
+            (tag, point) = self.points[i]
+            previous = points[-1][1] if points else None
+            if tag == "Draw" and previous != None:
+                # Simplify a run of straight lines, without its zero length lines
+                run = [previous]
+                while i < len(self.points) and self.points[i][0] == "Draw":
+                    if self.points[i][1].dist(run[-1]) >= epsilon:
+                        run.append(self.points[i][1])
+                    i += 1
+                points += [("Draw", point) for point in simplify_polyline(run, tolerance)[1:]]
+                continue
+            if tag == "Bezier1" and previous != None:
+                if all(self.points[i + j][1].dist(previous) < epsilon for j in range(3)):
+                    # A zero length curve
+                    i += 3
+                    continue
+            points.append(self.points[i])
+            i += 1
+
+        if not any(tag in ("Draw", "Bezier3") for (tag, point) in points):
+            # Keep a path of zero length as it was, its caps may still show
+            return
+
+        old_count = sum(1 for (tag, point) in self.points if point != None)
+        new_count = sum(1 for (tag, point) in points if point != None)
+        self.path_points += old_count
+        self.path_points_removed += old_count - new_count
+        self.points = points
 
     def write_path_components(self, fout):
+        if self.path_encoder != None:
+            for i in range(len(self.points)):
+                (tag, point) = self.points[i]
+                if tag == "Move":
+                    fout.write(self.path_encoder.move(point))
+                elif tag == "Draw":
+                    fout.write(self.path_encoder.line(point))
+                elif tag == "Bezier3":
+                    fout.write(self.path_encoder.curve(self.points[i-2][1], self.points[i-1][1], point))
+                elif tag == "Close":
+                    fout.write(self.path_encoder.close())
+            return
+
+        dp = self.path_dp
         newline_string = ""
         for point in self.points:
             svg_point = point[1]
             if point[0] == "Move":
-                fout.write("{0}M{1} {2}".format(newline_string, self.dp(svg_point.x), self.dp(svg_point.y)))
+                fout.write("{0}M{1} {2}".format(newline_string, dp(svg_point.x), dp(svg_point.y)))
             elif point[0] == "Draw":
-                fout.write("{0}L{1} {2}".format(newline_string, self.dp(svg_point.x), self.dp(svg_point.y)))
+                fout.write("{0}L{1} {2}".format(newline_string, dp(svg_point.x), dp(svg_point.y)))
             elif point[0] == "Bezier1":
-                fout.write("{0}C{1} {2} ".format(newline_string, self.dp(svg_point.x), self.dp(svg_point.y)))
+                fout.write("{0}C{1} {2} ".format(newline_string, dp(svg_point.x), dp(svg_point.y)))
             elif point[0] == "Bezier2":
-                fout.write("{0} {1} ".format(self.dp(svg_point.x), self.dp(svg_point.y)))
+                fout.write("{0} {1} ".format(dp(svg_point.x), dp(svg_point.y)))
             elif point[0] == "Bezier3":
-                fout.write("{0} {1}".format(self.dp(svg_point.x), self.dp(svg_point.y)))
+                fout.write("{0} {1}".format(dp(svg_point.x), dp(svg_point.y)))
             elif point[0] == "Close":
                 fout.write("{0}Z".format(newline_string))
             newline_string = "\n"
@@ -2633,51 +3618,158 @@ class Convertor:
             return "Finished"
         elif tag == Convertor.PATH_MOVE:
             point.read(fin)
-            svg_point = self.cc.draw_to_svg_point(point)
-            self.points.append(["Move", svg_point])
+            svg_point = self.path_cc.draw_to_svg_point(point)
+            self.points.append(("Move", svg_point))
             t = "     MOVE {0},{1}".format(self.dp(svg_point.x), self.dp(svg_point.y))
             message(2, t)
             return "Moved"
         elif tag == Convertor.PATH_CLOSE_SUB:
-            self.points.append(["Close", None])
+            self.points.append(("Close", None))
             return "Closed"
         elif tag == Convertor.PATH_DRAW:
             point.read(fin)
-            svg_point = self.cc.draw_to_svg_point(point)
-            self.points.append(["Draw", svg_point])
-            self.path_segments.append([self.points[-2][1], self.points[-1][1]])
+            svg_point = self.path_cc.draw_to_svg_point(point)
+            self.points.append(("Draw", svg_point))
             message(2, "     DRAW {0},{1}".format(self.dp(svg_point.x), self.dp(svg_point.y)))
         elif tag == Convertor.PATH_BEZIER:
             point.read(fin)
-            svg_point = self.cc.draw_to_svg_point(point)
-            self.points.append(["Bezier1", svg_point])
+            svg_point = self.path_cc.draw_to_svg_point(point)
+            self.points.append(("Bezier1", svg_point))
             message(2, "     BEZIER {0},{1},".format(self.dp(svg_point.x), self.dp(svg_point.y)), end="")
             point.read(fin)
-            svg_point = self.cc.draw_to_svg_point(point)
-            self.points.append(["Bezier2", svg_point])
+            svg_point = self.path_cc.draw_to_svg_point(point)
+            self.points.append(("Bezier2", svg_point))
             message(2, "{0},{1},".format(self.dp(svg_point.x), self.dp(svg_point.y)), end="")
             point.read(fin)
-            svg_point = self.cc.draw_to_svg_point(point)
-            self.points.append(["Bezier3", svg_point])
+            svg_point = self.path_cc.draw_to_svg_point(point)
+            self.points.append(("Bezier3", svg_point))
             message(2, "{0},{1}".format(self.dp(svg_point.x), self.dp(svg_point.y)))
 
-            # Split the bezier curve into this number of straight line segments
-            num_segments = 50
-
-            # This bezier curve
-            a = self.points[-4][1]
-            b = self.points[-3][1]
-            c = self.points[-2][1]
-            d = self.points[-1][1]
-
-            old_point = bezier(a,b,c,d,0)
-            for t in range(1, num_segments + 1):
-                new_point = bezier(a,b,c,d,t/num_segments)
-                self.path_segments.append([old_point, new_point])
-                old_point = new_point
-
         return "In Progress"
 
+    def flatten_path(self):
+        """Approximates the current simple path ('self.points') with straight line segments.
+        Returns lists of the start (x, y) and end (x, y) of each segment, its length, and the
+        cumulative length of the path at the end of each segment."""
+        if np != None:
+            return self.flatten_path_numpy()
+
+        segment_starts = []
+        segment_finishes = []
+        for i in range(len(self.points)):
+            (tag, point) = self.points[i]
+            if tag == "Draw":
+                start = self.points[i-1][1]
+                segment_starts.append((start.x, start.y))
+                segment_finishes.append((point.x, point.y))
+            elif tag == "Bezier3":
+                # This bezier curve
+                a = self.points[i-3][1]
+                b = self.points[i-2][1]
+                c = self.points[i-1][1]
+                d = point
+
+                # Split the bezier curve into this number of straight line segments
+                if self.config.flatness_tolerance is not None:
+                    num_segments = bezier_segment_count(a, b, c, d, self.config.flatness_tolerance * self.path_cc.pixel_size)
+                else:
+                    num_segments = 50
+
+                # Evaluate as bezier() does, but without making a Point for each step
+                old_point = (a.x, a.y)
+                for step in range(1, num_segments + 1):
+                    t = step / num_segments
+                    t2 = t * t
+                    t3 = t2 * t
+                    mt = 1-t
+                    mt2 = mt * mt
+                    mt3 = mt2 * mt
+                    new_point = (a.x*mt3 + b.x*mt2*t*3 + c.x*mt*t2*3 + d.x*t3,
+                                 a.y*mt3 + b.y*mt2*t*3 + c.y*mt*t2*3 + d.y*t3)
+                    segment_starts.append(old_point)
+                    segment_finishes.append(new_point)
+                    old_point = new_point
+
+        segment_lengths = []
+        segment_ends = []
+        total_length = 0
+        for ((x0, y0), (x1, y1)) in zip(segment_starts, segment_finishes):
+            length = math.sqrt((x1 - x0)*(x1 - x0) + (y1 - y0)*(y1 - y0))
+            total_length += length
+            segment_lengths.append(length)
+            segment_ends.append(total_length)
+
+        return (segment_starts, segment_finishes, segment_lengths, segment_ends)
+
+    def flatten_path_numpy(self):
+        """As flatten_path(), but evaluates every curve of the path at once using NumPy, and
+        returns NumPy arrays"""
+
+        # Gather control points for each line and curve. A line is treated as a curve with
+        # control points at each end, split into one segment.
+        control_points = []
+        is_curve = []
+        for i in range(len(self.points)):
+            (tag, point) = self.points[i]
+            if tag == "Draw":
+                start = self.points[i-1][1]
+                control_points.append((start.x, start.y, start.x, start.y, point.x, point.y, point.x, point.y))
+                is_curve.append(False)
+            elif tag == "Bezier3":
+                a = self.points[i-3][1]
+                b = self.points[i-2][1]
+                c = self.points[i-1][1]
+                control_points.append((a.x, a.y, b.x, b.y, c.x, c.y, point.x, point.y))
+                is_curve.append(True)
+
+        if len(control_points) == 0:
+            return (np.empty((0, 2)), np.empty((0, 2)), np.empty(0), np.empty(0))
+
+        control_points = np.array(control_points).reshape(-1, 4, 2)
+        (a, b, c, d) = (control_points[:, 0], control_points[:, 1], control_points[:, 2], control_points[:, 3])
+
+        # Number of straight line segments for each curve, as bezier_segment_count()
+        tolerance = self.config.flatness_tolerance
+        if tolerance is not None:
+            tolerance *= self.path_cc.pixel_size
+            dd1 = a - 2*b + c
+            dd2 = b - 2*c + d
+            dd = np.maximum(np.hypot(dd1[:, 0], dd1[:, 1]), np.hypot(dd2[:, 0], dd2[:, 1]))
+            counts = np.clip(np.ceil(np.sqrt(0.75 * dd / tolerance)), 1, 1000).astype(int)
+        else:
+            counts = np.full(len(control_points), 50)
+        counts[~np.array(is_curve)] = 1
+
+        # Evaluate each curve at t = 0, 1/n, 2/n ... 1 where n is its number of segments
+        vertex_counts = counts + 1
+        first_vertex = np.cumsum(vertex_counts) - vertex_counts
+        steps = np.arange(vertex_counts.sum()) - np.repeat(first_vertex, vertex_counts)
+        t  = (steps / np.repeat(counts, vertex_counts))[:, np.newaxis]
+        t2 = t * t
+        t3 = t2 * t
+        mt = 1 - t
+        mt2 = mt * mt
+        mt3 = mt2 * mt
+        a = np.repeat(a, vertex_counts, axis=0)
+        b = np.repeat(b, vertex_counts, axis=0)
+        c = np.repeat(c, vertex_counts, axis=0)
+        d = np.repeat(d, vertex_counts, axis=0)
+        vertices = a*mt3 + b*mt2*t*3 + c*mt*t2*3 + d*t3
+
+        # Each segment joins consecutive vertices of the same curve
+        is_start = np.ones(len(vertices), dtype=bool)
+        is_start[first_vertex + counts] = False
+        is_finish = np.ones(len(vertices), dtype=bool)
+        is_finish[first_vertex] = False
+        segment_starts = vertices[is_start]
+        segment_finishes = vertices[is_finish]
+
+        delta = segment_finishes - segment_starts
+        segment_lengths = np.sqrt(delta[:, 0]*delta[:, 0] + delta[:, 1]*delta[:, 1])
+        segment_ends = np.cumsum(segment_lengths)
+
+        return (segment_starts, segment_finishes, segment_lengths, segment_ends)
+
     def read_group_object(self, fin, fout, object_header):
         groupname = Convertor.read_name_string(fin, 12).strip()
         message(2, '  Group Name: {0}'.format(groupname))
@@ -2726,6 +3818,13 @@ class Convertor:
             self.dpi_x = None
             self.dpi_y = None
 
+            # Area of the sprite (left, top, right, bottom in pixels) actually encoded, if the
+            # transparent border has been cropped away.
+            self.crop_box = None
+
+            # Size of one image pixel when drawn on the page, in SVG pixels
+            self.display_scale = None
+
             # Old style sprites (Pre RISC-OS 3.5) just have a MODE number < 256
             if self.old_format_sprite:
                 # MODE number
@@ -2952,8 +4051,7 @@ class Convertor:
                             colpal += [red, green, blue, 255]
         return colpal
 
-    def read_sprite(self, sprite_ctrl_block, sprite_bytes):
-
+    def read_sprite_info(self, sprite_ctrl_block, sprite_bytes):
         # parse sprite info from header
         try:
             sprite_info = Convertor.SpriteInfo(sprite_ctrl_block)
@@ -2962,17 +4060,26 @@ class Convertor:
 
         # get palette
         colpal = self.parse_palette_data(sprite_info.bpp, sprite_ctrl_block, sprite_bytes)
+        return (sprite_info, colpal)
 
+    def read_sprite_rows(self, sprite_ctrl_block, sprite_bytes, sprite_info, colpal, first_row, last_row):
+        # Decodes the rows [first_row, last_row) of the sprite into an image. Rows are
+        # independent of each other, so a large sprite can be decoded a band at a time.
         ins = sprite_ctrl_block.image-Convertor.SpriteCtrlBlock.size()    # Offset into sprite to read from
         inm = sprite_info.maskbits                                        # Offset into mask to read from
         sprite_pixels = []      # Sprite pixels to write to
 
+        # skip to the first row to decode
+        ins += first_row * sprite_info.stride
+        if inm != None:
+            inm += first_row * sprite_info.mask_stride
+
         if sprite_info.bpp <= 8:
             # retrieve pixels from sprite_bytes
             bitmask = (1 << sprite_info.bpp) - 1
             shift   = 0
 
-            for row in range(sprite_info.height):
+            for row in range(first_row, last_row):
                 # remember the offset at the start of the row
                 tmpins = ins
                 tmpinm = inm
@@ -3073,7 +4180,7 @@ class Convertor:
             colour_format = sprite_info.colour_format.split(' ')[0]
 
             i = 0
-            for row in range(sprite_info.height):
+            for row in range(first_row, last_row):
                 tmpins = ins
                 tmpinm = inm
 
@@ -3192,23 +4299,26 @@ class Convertor:
             firstbit = 0
             sprite_pixels = bytes(sprite_pixels)
 
-        byte_count_in_theory = sprite_info.width * sprite_info.xf * sprite_info.height * sprite_info.yf * sprite_info.bpp // 8
+        rows = last_row - first_row
+        byte_count_in_theory = sprite_info.width * sprite_info.xf * rows * sprite_info.yf * sprite_info.bpp // 8
         if len(sprite_pixels) < byte_count_in_theory:
             error("incorrect number of pixels in image data")
             message(0, "width * height * xf * yf * bpp/8={0}".format(byte_count_in_theory))
             message(0, "len(sprite_pixels)={0}".format(len(sprite_pixels)))
-            return (None, None)
+            return None
 
-        # Make PNG data
+        # Make image
         # mode 'P' means 8 bit with colour palette
         png_colour_format = sprite_info.colour_format.split(' ')[0]
         if png_colour_format != "CMYK" and png_colour_format != "KYMC" and png_colour_format != 'YCbCr':
             png_colour_format = "RGBA"
 
-        im = Image.frombytes(png_colour_format, (sprite_info.width * sprite_info.xf, sprite_info.height * sprite_info.yf), sprite_pixels, decoder_name='raw')
+        im = Image.frombytes(png_colour_format, (sprite_info.width * sprite_info.xf, rows * sprite_info.yf), sprite_pixels, decoder_name='raw')
         #if colpal:
         #    im.putpalette(colpal, rawmode='RGBA')
+        return im
 
+    def encode_png(self, im):
         # DEBUG: Save PNGs to files on disk
         #global debug
         #im.save("temp{0}.png".format(debug), "png")
@@ -3217,9 +4327,176 @@ class Convertor:
         # Return PNG data
         byteIO = io.BytesIO()
         im.save(byteIO, format='PNG')       # DEBUG: 'Save' PNG to byte array
-        byteArr = byteIO.getvalue()
+        return byteIO.getvalue()
+
+    def encode_image(self, im):
+        # Encode a sprite image in the chosen image format. Returns the data and its MIME type.
+        start_time = time.perf_counter()
+        if self.image_format == "png":
+            image_data = self.encode_png(im)
+            mime_type = "image/png"
+        else:
+            # WebP only supports RGB(A) images
+            if im.mode != "RGB" and im.mode != "RGBA":
+                im = im.convert("RGBA")
+
+            byteIO = io.BytesIO()
+            im.save(byteIO, format='WEBP', lossless=True)
+            image_data = byteIO.getvalue()
+            mime_type = "image/webp"
+
+            # Sprites with few colours are often smaller lossless, so keep whichever is smallest
+            if self.image_format == "webp":
+                byteIO = io.BytesIO()
+                im.save(byteIO, format='WEBP', quality=self.config.image_quality)
+                if len(byteIO.getvalue()) < len(image_data):
+                    image_data = byteIO.getvalue()
+
+        self.image_encode_time += time.perf_counter() - start_time
+        return (image_data, mime_type)
+
+    def transcode_jpeg(self, jpeg_data):
+        # Re-encode JPEG data as lossy WebP. Returns None if that isn't possible or doesn't
+        # make it any smaller.
+        start_time = time.perf_counter()
+        try:
+            im = Image.open(io.BytesIO(jpeg_data))
+            if im.mode != "RGB" and im.mode != "L":
+                im = im.convert("RGB")
+            byteIO = io.BytesIO()
+            im.save(byteIO, format='WEBP', quality=self.config.image_quality)
+            webp_data = byteIO.getvalue()
+        except Exception as e:
+            warning("Could not transcode JPEG to WebP ({0}), keeping the JPEG".format(e))
+            webp_data = None
+        self.image_encode_time += time.perf_counter() - start_time
+
+        if webp_data == None or len(webp_data) >= len(jpeg_data):
+            return None
+        message(2, "   Transcoded JPEG to WebP: {0} -> {1} bytes".format(len(jpeg_data), len(webp_data)))
+        return webp_data
 
-        return (byteArr, sprite_info)
+    def read_view(self, f, length):
+        """Reads 'length' bytes as a view into the memory mapped input file, without copying."""
+        if self.file_view == None:
+            return f.read(length)
+
+        pos = f.tell()
+        view = self.file_view[pos:pos + length]
+        f.seek(pos + len(view))
+        return view
+
+    def write_base64(fout, data):
+        # Encode in chunks, so there's never a full size copy of the base64 text in memory.
+        # The chunk size is a multiple of three bytes so the chunks join up without padding.
+        chunk_size = 3 * 65536
+        for i in range(0, len(data), chunk_size):
+            fout.write(base64.b64encode(data[i:i + chunk_size]).decode('ascii'))
+
+    def write_image_data(self, fout, image_data, mime_type):
+        # Output image data in base64
+        self.image_count += 1
+        self.image_bytes += len(image_data)
+        fout.write('xlink:href="data:{0};base64,'.format(mime_type))
+        Convertor.write_base64(fout, image_data)
+
+    def crop_transparent_border(self, im):
+        # Masked sprites often have large fully transparent margins. There's no need to encode
+        # them, so crop the image to the bounding box of the opaque pixels. Returns the image
+        # and the crop box (or None if nothing was cropped) so the image can still be placed
+        # pixel-exactly.
+        if im.mode != "RGBA":
+            return (im, None)
+
+        bbox = im.getchannel("A").getbbox()
+        if bbox == None:
+            # Entirely transparent, just keep a single (transparent) pixel
+            bbox = (0, 0, 1, 1)
+        if bbox == (0, 0, im.width, im.height):
+            # Nothing to crop
+            return (im, None)
+
+        message(2, "   Cropped transparent border: {0}".format(bbox))
+        return (im.crop(bbox), bbox)
+
+    def max_dpi_size(self, size, display_scale):
+        # Returns the image size needed so that when displayed, the image is at most
+        # 'config.max_dpi' dots per inch. 'display_scale' is the size of one image pixel
+        # on the page in SVG pixels, which are 1/96 inch.
+        (width, height) = size
+        max_dpi = self.config.max_dpi
+        if not max_dpi:
+            return size
+
+        if display_scale.x > epsilon and 96 / display_scale.x > max_dpi:
+            width = max(1, round(width * display_scale.x * max_dpi / 96))
+        if display_scale.y > epsilon and 96 / display_scale.y > max_dpi:
+            height = max(1, round(height * display_scale.y * max_dpi / 96))
+        return (width, height)
+
+    def limit_image_dpi(self, im, display_scale):
+        # Resample the image down if it would be displayed at more than the maximum DPI
+        size = self.max_dpi_size(im.size, display_scale)
+        if size == im.size:
+            return im
+
+        message(2, "   Resampled image from {0}x{1} to {2}x{3} pixels".format(im.width, im.height, size[0], size[1]))
+        return im.resize(size, Image.Resampling.LANCZOS)
+
+    def write_sprite_image(self, fout, sprite_info, im, left, top, width, height, transform):
+        # Output the encoded image. 'left', 'top', 'width' and 'height' position the image
+        # within the sprite's own pixel coordinates.
+        position = ""
+        if left != 0 or top != 0:
+            position = 'x="{0}" y="{1}" '.format(left, top)
+
+        resampled_im = self.limit_image_dpi(im, sprite_info.display_scale)
+        image_data, mime_type = self.encode_image(resampled_im)
+
+        if resampled_im is not im:
+            # Resampling sprite art introduces new colours, which can make it bigger rather than
+            # smaller once encoded. So images with few colours are encoded at full size too, and
+            # the resampled image is only used if it's smaller.
+            if im.getcolors(256) != None:
+                full_data, full_mime_type = self.encode_image(im)
+                if len(full_data) <= len(image_data):
+                    (image_data, mime_type) = (full_data, full_mime_type)
+                    resampled_im = im
+
+            # A resampled image is stretched to fill exactly the same area
+            if resampled_im is not im and resampled_im.size != (width, height):
+                position += 'preserveAspectRatio="none" '
+        fout.write('<image {0}width="{1}" height="{2}" image-rendering="pixelated" transform="{3}" '.format(
+            position,
+            self.dp(width),
+            self.dp(height),
+            transform))
+        self.write_image_data(fout, image_data, mime_type)
+        fout.write('" />\n')
+
+    def write_sprite_tiles(self, fout, sprite_ctrl_block, sprite_bytes, sprite_info, colpal, transform):
+        # Decode, encode and output the sprite one horizontal band of rows at a time, so only
+        # one band's pixels (and PNG) are held in memory at once, however large the sprite.
+        tile_rows = self.config.sprite_tile_rows
+        for first_row in range(0, sprite_info.height, tile_rows):
+            last_row = min(first_row + tile_rows, sprite_info.height)
+            im = self.read_sprite_rows(sprite_ctrl_block, sprite_bytes, sprite_info, colpal, first_row, last_row)
+            if im == None:
+                exit(1)
+
+            left = 0
+            top = first_row * sprite_info.yf
+            if self.config.crop_sprites:
+                # Entirely transparent bands needn't be output at all
+                if im.mode == "RGBA" and im.getchannel("A").getbbox() == None:
+                    continue
+                im, crop_box = self.crop_transparent_border(im)
+                if crop_box:
+                    left += crop_box[0]
+                    top  += crop_box[1]
+
+            message(2, "   Tile rows {0}-{1}".format(first_row, last_row - 1))
+            self.write_sprite_image(fout, sprite_info, im, left, top, im.width, im.height, transform)
 
     def read_sprite_object(self, fin, fout, object_header):
         matrix = Convertor.DrawMatrix()
@@ -3256,10 +4533,11 @@ class Convertor:
         message(2, "   Mask:      {0}".format(hex(sprite_ctrl_block.mask)))
         message(2, "   Transformation: {0}".format(transform))
 
-        # Read 'length' bytes of sprite data, parse it and store it as an embedded PNG? image
-        sprite_bytes = fin.read(length)
-        png_data, sprite_info = self.read_sprite(sprite_ctrl_block, sprite_bytes)
-        if png_data == None:
+        # Read 'length' bytes of sprite data, parse it and store it as an embedded PNG? image.
+        # The sprite data is a view into the input file, so it isn't copied.
+        sprite_bytes = self.read_view(fin, length)
+        sprite_info, colpal = self.read_sprite_info(sprite_ctrl_block, sprite_bytes)
+        if sprite_info == None:
             exit(1)
 
         width = sprite_info.width * sprite_info.xf
@@ -3286,6 +4564,9 @@ class Convertor:
                 self.dp(scale_x),
                 self.dp(scale_y),
                 self.dp(-height))
+
+            sprite_info.display_scale = Point(math.hypot(matrix.a, matrix.b) * scale_x,
+                                              math.hypot(matrix.c, matrix.d) * scale_y)
         else:
             # The bounding box of an object in Draw specifies the bottom left and top right points
             # on the page for that object. This description remains true when converted to SVG
@@ -3303,15 +4584,152 @@ class Convertor:
                 self.dp((top_right.x - bottom_left.x) / width),
                 self.dp((bottom_left.y - top_right.y) / height))
 
-        # Output PNG data in base64
-        base64_data = base64.b64encode(png_data).decode('ascii')
-        fout.write('<image width="{0}" height="{1}" image-rendering="pixelated" transform="{2}" '.format(
-            self.dp(width),
-            self.dp(height),
-            transform))
-        fout.write('xlink:href="data:image/png;base64,')
-        fout.write(base64_data)
-        fout.write('" />\n')
+            sprite_info.display_scale = Point(abs(top_right.x - bottom_left.x) / width,
+                                              abs(bottom_left.y - top_right.y) / height)
+
+        # Large sprites are output in bands to bound memory use
+        tile_rows = self.config.sprite_tile_rows
+        if tile_rows > 0 and sprite_info.height > tile_rows:
+            self.write_sprite_tiles(fout, sprite_ctrl_block, sprite_bytes, sprite_info, colpal, transform)
+            return
+
+        im = self.read_sprite_rows(sprite_ctrl_block, sprite_bytes, sprite_info, colpal, 0, sprite_info.height)
+        if im == None:
+            exit(1)
+
+        # If the transparent border was cropped, place the smaller image at the same position
+        # within the (unchanged) sprite coordinate space
+        left = 0
+        top = 0
+        if self.config.crop_sprites:
+            im, sprite_info.crop_box = self.crop_transparent_border(im)
+            if sprite_info.crop_box:
+                (left, top, right, bottom) = sprite_info.crop_box
+                width  = right - left
+                height = bottom - top
+
+        self.write_sprite_image(fout, sprite_info, im, left, top, width, height, transform)
+
+    def jpeg_resample_size(self, jpeg_data, wh, matrix):
+        # Returns the size in pixels to resample JPEG data to, so it isn't displayed at more
+        # than the maximum DPI, or None if it doesn't need resampling. 'wh' is the displayed
+        # size in SVG pixels before the transformation 'matrix' is applied. Only the JPEG
+        # header is read, the image isn't decoded.
+        try:
+            im = Image.open(io.BytesIO(jpeg_data))
+        except Exception as e:
+            warning("Could not resample JPEG ({0}), keeping the original".format(e))
+            return None
+
+        display_scale = Point(wh.x * math.hypot(matrix.a, matrix.b) / im.width,
+                              wh.y * math.hypot(matrix.c, matrix.d) / im.height)
+        size = self.max_dpi_size(im.size, display_scale)
+        if size == im.size:
+            return None
+        return size
+
+    def downsample_jpeg(self, jpeg_data, size):
+        # Resample JPEG data down to 'size' pixels. Returns the new JPEG data, or None if it
+        # can't be resampled or the resampled data is no smaller than the original.
+        try:
+            im = Image.open(io.BytesIO(jpeg_data))
+
+            # Let the JPEG decoder scale down by a power of two first, which is much faster
+            # than decoding at full size
+            original_size = im.size
+            icc_profile = im.info.get("icc_profile")
+            im.draft(im.mode, size)
+            im = im.resize(size, Image.Resampling.LANCZOS)
+
+            # Keep any ICC profile, as it affects the colours
+            byteIO = io.BytesIO()
+            im.save(byteIO, format='JPEG', quality=self.config.image_quality, icc_profile=icc_profile)
+        except Exception as e:
+            warning("Could not resample JPEG ({0}), keeping the original".format(e))
+            return None
+
+        if byteIO.tell() >= len(jpeg_data):
+            message(2, "   Resampled JPEG is no smaller, keeping the original: {0} -> {1} bytes".format(len(jpeg_data), byteIO.tell()))
+            return None
+
+        message(2, "   Resampled JPEG from {0}x{1} to {2}x{3} pixels".format(original_size[0], original_size[1], size[0], size[1]))
+        return byteIO.getvalue()
+
+    def process_jpeg(self, jpeg_data, resample_size):
+        # Resample the JPEG data to 'resample_size' (unless None) and transcode it, as
+        # configured. Returns (data, MIME type, resampled size), where the data is None if
+        # the original data is kept as it is, and the resampled size is None if it wasn't
+        # resampled.
+        data = None
+        mime_type = "image/jpg"
+        if resample_size != None:
+            data = self.downsample_jpeg(jpeg_data, resample_size)
+            if data == None:
+                resample_size = None
+
+        # Lossy WebP is usually smaller than the original JPEG
+        if self.image_format == "webp":
+            webp_data = self.transcode_jpeg(data if data != None else jpeg_data)
+            if webp_data != None:
+                data = webp_data
+                mime_type = "image/webp"
+        return (data, mime_type, resample_size)
+
+    def strip_jpeg_metadata(jpeg_data):
+        # Returns the JPEG data without the segments that only hold metadata (EXIF, XMP,
+        # comments, etc.), without decoding the image. The JFIF (APP0) and Adobe (APP14)
+        # segments affect how the image is decoded, and ICC profiles affect the colours, so
+        # these are kept. Data that can't be parsed is returned unchanged.
+        if len(jpeg_data) < 4 or jpeg_data[0] != 0xFF or jpeg_data[1] != 0xD8:
+            return jpeg_data
+
+        parts = [jpeg_data[0:2]]
+        pos = 2
+        stripped = 0
+        while pos + 4 <= len(jpeg_data):
+            if jpeg_data[pos] != 0xFF:
+                return jpeg_data
+
+            marker = jpeg_data[pos + 1]
+            if marker == 0xFF:
+                # Fill byte
+                pos += 1
+                continue
+            if marker == 0xDA or marker == 0xD9:
+                # Start of scan or end of image. Everything else is image data.
+                break
+            if (0xD0 <= marker <= 0xD7) or marker == 0x01:
+                # Markers without a segment length
+                parts.append(jpeg_data[pos:pos + 2])
+                pos += 2
+                continue
+
+            length = (jpeg_data[pos + 2] << 8) | jpeg_data[pos + 3]
+            end = pos + 2 + length
+            if length < 2 or end > len(jpeg_data):
+                return jpeg_data
+
+            if marker == 0xFE:
+                # Comment
+                metadata = True
+            elif 0xE1 <= marker <= 0xEF and marker != 0xEE:
+                # APPn segment, except APP14 (Adobe) and ICC profiles in APP2
+                metadata = not (marker == 0xE2 and bytes(jpeg_data[pos + 4:pos + 16]) == b"ICC_PROFILE\0")
+            else:
+                metadata = False
+
+            if metadata:
+                stripped += end - pos
+            else:
+                parts.append(jpeg_data[pos:end])
+            pos = end
+
+        if stripped == 0:
+            return jpeg_data
+
+        message(2, "   Stripped {0} bytes of JPEG metadata".format(stripped))
+        parts.append(jpeg_data[pos:])
+        return b"".join(parts)
 
     def read_jpeg_object(self, fin, fout, object_header):
         jpeg_header = Convertor.JpegHeader()
@@ -3326,9 +4744,9 @@ class Convertor:
 
         transform = self.get_sprite_transform(matrix, object_header)
 
-        jpeg_data = fin.read(jpeg_header.length)
-        base64_data = base64.b64encode(jpeg_data).decode('ascii')
-        fout.write("<image");
+        # JPEG data is passed straight through from the input file, unless it's resampled or
+        # transcoded
+        jpeg_data = self.read_view(fin, jpeg_header.length)
 
         # Note that the dimensions for JPEG objects are different to those for Sprite objects.
         # The width and height of the image is specified in the JPEGHeader, in Draw units.
@@ -3337,14 +4755,78 @@ class Convertor:
         wh = self.cc.draw_to_svg_size(Convertor.Coords(jpeg_header.width, jpeg_header.height))
         trans = Point(0,-wh.y)
 
-        fout.write(' x="{0}" y="{1}" width="{2}" height="{3}" transform="{4}"'.format(
-            self.dp(trans.x), self.dp(trans.y), self.dp(wh.x), self.dp(wh.y), transform))
-        fout.write(' xlink:href="data:image/jpg;base64,')
-        fout.write(base64_data)
-        fout.write('"/>\n')
+        if self.config.strip_jpeg_metadata:
+            jpeg_data = Convertor.strip_jpeg_metadata(jpeg_data)
+
+        resample_size = None
+        if self.config.max_dpi:
+            resample_size = self.jpeg_resample_size(jpeg_data, wh, matrix)
+
+        # Identical JPEG data is found from its content before resampling or transcoding it
+        digest = hashlib.sha1(jpeg_data).digest()
+
+        if self.config.dedupe_jpegs:
+            # Each distinct image is defined once, and used by every JPEG object that shows it.
+            # An image already defined can be used if it has at least as many pixels as needed.
+            for jpeg_def in self.jpeg_defs.get(digest, []):
+                (jpeg_id, def_wh, def_preserve_aspect_ratio, def_size) = jpeg_def
+                if def_size != None and (resample_size == None or def_size[0] < resample_size[0] or def_size[1] < resample_size[1]):
+                    continue
+
+                # The image can only be scaled to fit a different size if the aspect ratio is
+                # the same, or if the image is being stretched anyway
+                if def_preserve_aspect_ratio or abs(def_wh.x * wh.y - wh.x * def_wh.y) <= epsilon * def_wh.x * def_wh.y:
+                    message(2, "   Reusing identical image {0}".format(jpeg_id))
+                    self.write_jpeg_use(fout, jpeg_id, def_wh, wh, trans, transform)
+                    return
+
+        # Identical JPEG data is only resampled and transcoded once for each size
+        key = (digest, resample_size)
+        processed = self.jpeg_images.get(key)
+        if processed == None:
+            processed = self.process_jpeg(jpeg_data, resample_size)
+            self.jpeg_images[key] = processed
+        (data, mime_type, resample_size) = processed
+        if data != None:
+            jpeg_data = data
+        preserve_aspect_ratio = ""
+        if resample_size != None:
+            preserve_aspect_ratio = ' preserveAspectRatio="none"'
+
+        if not self.config.dedupe_jpegs:
+            fout.write("<image");
+            fout.write(' x="{0}" y="{1}" width="{2}" height="{3}"{4} transform="{5}"'.format(
+                self.dp(trans.x), self.dp(trans.y), self.dp(wh.x), self.dp(wh.y), preserve_aspect_ratio, transform))
+            fout.write(' ')
+            self.write_image_data(fout, jpeg_data, mime_type)
+            fout.write('"/>\n')
+            return
+
+        self.jpeg_count += 1
+        jpeg_id = "jpeg{0}".format(self.jpeg_count)
+        self.jpeg_defs.setdefault(digest, []).append((jpeg_id, wh, preserve_aspect_ratio, resample_size))
+
+        fout.write('<defs><image id="{0}" width="{1}" height="{2}"{3} '.format(
+            jpeg_id, self.dp(wh.x), self.dp(wh.y), preserve_aspect_ratio))
+        self.write_image_data(fout, jpeg_data, mime_type)
+        fout.write('"/></defs>\n')
+        self.write_jpeg_use(fout, jpeg_id, wh, wh, trans, transform)
+
+    def write_jpeg_use(self, fout, jpeg_id, def_wh, wh, trans, transform):
+        # Output a use of the image 'jpeg_id' defined with size 'def_wh', scaled to size 'wh'
+        if abs(def_wh.x - wh.x) < epsilon and abs(def_wh.y - wh.y) < epsilon:
+            fout.write('<use xlink:href="#{0}" x="{1}" y="{2}" transform="{3}"/>\n'.format(
+                jpeg_id, self.dp(trans.x), self.dp(trans.y), transform))
+        else:
+            fout.write('<use xlink:href="#{0}" transform="{1} translate({2} {3}) scale({4} {5})"/>\n'.format(
+                jpeg_id, transform, self.dp(trans.x), self.dp(trans.y),
+                self.dp(wh.x / def_wh.x), self.dp(wh.y / def_wh.y)))
 
     class TextState:
-        def __init__(self, font_replacements):
+        def __init__(self, font_replacements, config):
+            self.use_font_index       = config.font_index
+            self.font_family_names    = config.font_family_names
+            self.check_measurement    = config.check_text_measurement
             self.text_area_fonts      = {}
             self.text_area_fonts[0]   = Convertor.FontDesc("system", 24, 24, font_replacements)
             self.line_spacing_px      = CoordinateConversion.pt_to_px(10)
@@ -3379,22 +4861,26 @@ class Convertor:
                     try_fnames = [fname + " Italic"] + try_fnames
 
                 for try_fname in try_fnames:
-                    try:
-                        font_height_pixels = CoordinateConversion.pt_to_px(font_desc.height_pts)
-                        font = ImageFont.truetype(try_fname, font_height_pixels)
-
-                        # Variable fonts
-                        if (font != None) and try_fname == fname:
-                            try:
-                                if font_desc.weight == "bold" and b'Bold' in font.get_variation_names():
-                                    font.set_variation_by_name('Bold')
-                                if font_desc.weight == "italic" and b'Italic' in font.get_variation_names():
-                                    font.set_variation_by_name('Italic')
-                            except:
-                                continue
-                        return font
-                    except:
+                    # Variable fonts
+                    variation = None
+                    if try_fname == fname:
+                        if font_desc.weight == "bold":
+                            variation = "Bold"
+                        elif font_desc.weight == "italic":
+                            variation = "Italic"
+
+                    # Find the font's file first, so fonts are cached by the file they come from
+                    if self.use_font_index:
+                        try_fname = font_index.find(try_fname, self.font_family_names)
+                    else:
+                        try_fname = FontIndex.search(try_fname)
+                    if try_fname == None:
                         continue
+
+                    font_height_pixels = CoordinateConversion.pt_to_px(font_desc.height_pts)
+                    font = font_cache.load(try_fname, font_height_pixels, variation)
+                    if font != None:
+                        return font
             return None
 
         def to_utf8(self, config):
@@ -3412,8 +4898,24 @@ class Convertor:
 
             if not font_desc.font:
                 font_desc.font = self.create_font(font_desc)
-            self.length = font_desc.font.getlength(self.plain_text) * font_desc.width_pts / font_desc.height_pts
+            length = font_desc.font.getlength(self.plain_text)
+            if self.check_measurement:
+                # Compare with laying out the whole text
+                expected = font_desc.font.font.getlength(self.plain_text)
+                if abs(length - expected) > epsilon:
+                    warning("Text measured as {0} pixels rather than {1}: {2}".format(length, expected, self.plain_text))
+            self.length = length * font_desc.width_pts / font_desc.height_pts
             assert(self.length != None)
+
+        def set_length(self, length):
+            """Sets the length of the text from a 'length' in pixels found by other means, as
+            measure() would set it"""
+            font_desc = self.text_area_fonts[self.font_index]
+            if self.check_measurement:
+                self.measure()
+                if abs(self.length - length * font_desc.width_pts / font_desc.height_pts) > epsilon:
+                    warning("Text length found as {0} pixels rather than {1}: {2}".format(length, self.length, self.plain_text))
+            self.length = length * font_desc.width_pts / font_desc.height_pts
             #self.bbox = font_desc.font.getbbox(self.plain_text)
 
 
@@ -3436,9 +4938,97 @@ class Convertor:
             message(verbose_level, "    #FONTS DFINED: {0}".format(len(self.text_area_fonts)))
             message(verbose_level, "    MEASURELENGTH: {0}".format(self.length))
 
+    class LineBreaker:
+        """Finds where to break the text of a run that is too long for its line. The text is
+        measured once, then any part of it is measured from the lengths of its prefixes, and
+        the lines only need to look at the few places to break near their ends."""
+
+        def __init__(self, text_state):
+            self.text = text_state.plain_text
+            font_desc = text_state.text_area_fonts[text_state.font_index]
+            self.font = font_desc.font
+            self.width_pts = font_desc.width_pts
+            self.height_pts = font_desc.height_pts
+
+            # Places to break the text (spaces and soft hyphens)
+            self.breaks = [i for (i, char) in enumerate(self.text) if char in " \u00ad"]
+
+            # Lengths can only be found this way for fonts with basic layout. The text can then
+            # be searched for where it stops fitting, if shorter text is never longer.
+            self.prefix_lengths = self.font.prefix_lengths(self.text)
+            self.hyphen_lengths = {}
+            self.can_search = (self.prefix_lengths != None and
+                               all(a <= b for (a, b) in zip(self.prefix_lengths, self.prefix_lengths[1:])) and
+                               all(self.hyphen_length(self.text[i-1]) >= 0 for i in self.breaks if i > 0 and self.text[i] != " "))
+
+        def hyphen_length(self, previous):
+            """The length added by a hyphen after the character 'previous'"""
+            length = self.hyphen_lengths.get(previous)
+            if length == None:
+                length = self.hyphen_lengths[previous] = self.font.getlength(previous + "-") - self.font.getlength(previous)
+            return length
+
+        def length(self, start, end, hyphen=False):
+            """The length in pixels of the text from 'start' to 'end', with a hyphen added"""
+            if self.prefix_lengths == None:
+                return self.font.getlength(self.text[start:end] + ("-" if hyphen else ""))
+
+            length = self.prefix_lengths[end] - self.prefix_lengths[start]
+            if 0 < start < end:
+                # Without the kerning before the start
+                length -= self.font.kerning[self.text[start-1:start+1]]
+            if hyphen:
+                length += self.hyphen_length(self.text[end-1])
+            return length
+
+        def find_break(self, start, previous_width, line_width, spaces_on_line):
+            """Returns where to break the text from 'start' (which doesn't fit on the line)
+            as (end, hyphen), or None if none of it is to go on the line.
+
+            Like someone trying to fit the text by hand, this cuts the text back to each place to
+            break it in turn, from the end, until it fits. A soft hyphen is replaced by a hyphen.
+            If there are no more places to break it (it is one word), the word is cut back one
+            character at a time, unless it follows other words on the line, when it is moved to the
+            next line instead. At least one character is kept."""
+            scale = lambda length: length * self.width_pts / self.height_pts
+            fits = lambda end, hyphen: not (previous_width + scale(self.length(start, end, hyphen)) > line_width)
+
+            # Cuts after the last end that fits can't fit, so needn't be tried
+            last_end = len(self.text)
+            if self.can_search:
+                (low, high) = (start, len(self.text))
+                while low < high:
+                    middle = (low + high + 1) // 2
+                    if fits(middle, False):
+                        low = middle
+                    else:
+                        high = middle - 1
+                last_end = max(low, start + 1)
+
+            # Cut back to each place to break the text in turn
+            cut = (len(self.text), False)
+            for i in reversed(range(bisect.bisect_left(self.breaks, start + 1), bisect.bisect_right(self.breaks, last_end))):
+                end = self.breaks[i]
+                cut = (end, self.text[end] != " ")
+                if fits(*cut) or end - start + cut[1] <= 1:
+                    return cut
+            if len(self.text) - start <= 1:
+                return cut
+
+            if spaces_on_line > 0:
+                return None
+
+            # Cut back one character at a time
+            end = min(cut[0] - (0 if cut[1] else 1), last_end)
+            while end - start > 1 and not fits(end, False):
+                end -= 1
+            return (end, False)
+
     class TextRun:
         def __init__(self, text_state):
             self.text_state = copy.copy(text_state)
+            self.line_breaker = None
+            self.line_breaker_start = 0     # Where the text starts in the line breaker's text
 
         def measure(self):
             self.text_state.measure()
@@ -3460,32 +5050,51 @@ class Convertor:
     # Optional forward slash pattern
     OPTIONAL_TERM = br"\/?"
 
-    # All patterns to test
+    # All patterns to test, in order
     patterns = { # Terminates with forward-slash or newline
                  br'\\! *\d+[\/ \n]':                                                    "version",
-                 br'^\\B *(\d+)[ \t]+(\d+)[ \t]+(\d+)[ \t]*[\/\n]':                      "background",
-                 br'^\\C *(\d+)[ \t]+(\d+)[ \t]+(\d+)[ \t]*[\/\n]':                      "colour",
-                 br'^\\D *(\d+)[\/ \n]':                                                 "columns",
-                 br'^\\F[ \t]*(\d+)[ \t]*([^ \t]*)[ \t]*(\d+)[ \t]*[\/\n]':              "font size",
-                 br'^\\F[ \t]*(\d+)[ \t]*([^ \t]*)[ \t]*(\d+)[ \t]*(\d+)[ \t]*[\/\n]':   "font size width",
-                 br'^\\L *(-?\d+)[\/\n]':                                                "line leading",
-                 br'^\\M *(\d+) +(\d+)[\/\n]':                                           "margins",
-                 br'^\\P *(-?\d+)[\/\n]':                                                "paragraph leading",
-                 br'^\\U *(-?\d+) +(-?\d+) *[\/\n]':                                     "underline",
+                 br'\\B *(\d+)[ \t]+(\d+)[ \t]+(\d+)[ \t]*[\/\n]':                       "background",
+                 br'\\C *(\d+)[ \t]+(\d+)[ \t]+(\d+)[ \t]*[\/\n]':                       "colour",
+                 br'\\D *(\d+)[\/ \n]':                                                  "columns",
+                 br'\\F[ \t]*(\d+)[ \t]*([^ \t]*)[ \t]*(\d+)[ \t]*[\/\n]':               "font size",
+                 br'\\F[ \t]*(\d+)[ \t]*([^ \t]*)[ \t]*(\d+)[ \t]*(\d+)[ \t]*[\/\n]':    "font size width",
+                 br'\\L *(-?\d+)[\/\n]':                                                 "line leading",
+                 br'\\M *(\d+) +(\d+)[\/\n]':                                            "margins",
+                 br'\\P *(-?\d+)[\/\n]':                                                 "paragraph leading",
+                 br'\\U *(-?\d+) +(-?\d+) *[\/\n]':                                      "underline",
 
                  # Optional forward slash terminator
-                 br'^\\A(.)'+OPTIONAL_TERM:                                              "alignment",
-                 br'^\\U\.'+OPTIONAL_TERM:                                               "underline end",
-                 br'^\\V(-?\d+)'+OPTIONAL_TERM:                                          "vertical move",
-                 br'^\\-'+OPTIONAL_TERM:                                                 "soft hyphen",
-                 br'^\\\n'+OPTIONAL_TERM:                                                "line break",
-                 br'^\\\\'+OPTIONAL_TERM:                                                "slash",
-                 br'^\\(\d+)'+OPTIONAL_TERM:                                             "setfont",
+                 br'\\A(.)'+OPTIONAL_TERM:                                               "alignment",
+                 br'\\U\.'+OPTIONAL_TERM:                                                "underline end",
+                 br'\\V(-?\d+)'+OPTIONAL_TERM:                                           "vertical move",
+                 br'\\-'+OPTIONAL_TERM:                                                  "soft hyphen",
+                 br'\\\n'+OPTIONAL_TERM:                                                 "line break",
+                 br'\\\\'+OPTIONAL_TERM:                                                 "slash",
+                 br'\\(\d+)'+OPTIONAL_TERM:                                              "setfont",
 
                  # Must end with a newline
-                 br'^\\;(.*)?\n':                                                        "comment",
+                 br'\\;(.*)?\n':                                                         "comment",
                }
 
+    def combine_patterns(patterns):
+        """Combine the patterns into a single regular expression, each pattern in its own group,
+           along with a dictionary from the index of each pattern's group to the pattern's name"""
+        names = {}
+        group_index = 1
+        for (pattern, name) in patterns.items():
+            names[group_index] = name
+            group_index += 1 + re.compile(pattern).groups
+        return (re.compile(b"|".join(b"(" + pattern + b")" for pattern in patterns)), names)
+
+    (patterns_regex, pattern_names) = combine_patterns(patterns)
+
+    # Text that is copied as is: everything up to the next backslash or newline
+    plain_text_regex = re.compile(br"[^\\\n]+")
+
+    # "1. control characters are deleted, except for tab, which is replaced by a space."
+    control_characters_table  = bytes.maketrans(b"\t", b" ")
+    control_characters_delete = bytes(c for c in range(32) if c != 9 and c != 10)
+
     def parse_text_area_text(self, text_bytes, text_columns, fout):
         """Parse the text from the Draw file text area including escape sequences to create a list
            of TextRun objects, each holding a run of text in a given font/style"""
@@ -3495,184 +5104,182 @@ class Convertor:
         # "1. control characters are deleted, except for tab, which is replaced by a space."
         # "2. All other characters are copied, except '\', which is interpreted according to the
         #     next character, and newline (see below)"
-        remaining_text_bytes = bytearray(b'')
-        for c in text_bytes:
-            if c == 9:
-                c = 32
-            elif (c < 32) and (c != 10):
-                continue
-            remaining_text_bytes.append(c)
+        text = bytes(text_bytes).translate(Convertor.control_characters_table, Convertor.control_characters_delete)
 
         # Initialise to default state
-        text_state = Convertor.TextState(self.font_replacements)              # Current state
+        text_state = Convertor.TextState(self.font_replacements, self.config)              # Current state
         text_state.num_columns = len(text_columns)
         self.text_runs = []
         no_text_output_yet = True
         beginning_of_paragraph = True
         previous_byte = b""
 
-        while len(remaining_text_bytes)>0:
-
-            offset = 1
-            for p in Convertor.patterns.items():
-                matched = re.match(p[0], remaining_text_bytes)
-                if matched:
-                    offset = len(matched.group(0))
-
-                    # First check for commands that won't break a text run
-                    if p[1] == "slash":
-                        text_state.plain_text += b"\\"
-                        previous_byte = b"\\"
-                        no_text_output_yet = False
-                        beginning_of_paragraph = False
-                    elif p[1] == "comment":
-                        message(2, "Comment: {0}".format(matched.group(1)))
-                    elif p[1] == "soft hyphen":
-                        message(2, "Soft Hyphen")
-                        text_state.plain_text += b'\xad'
-                        previous_byte = '\u00ad'
-                    else:
-                        # Found a command that breaks a run. First finish the previous text run (if any).
-                        self.store_text_run(text_state)
+        # Scan through the text once, with 'index' the position of the next character to handle
+        index = 0
+        while index < len(text):
+            # Copy plain text up to the next backslash or newline in one go
+            plain = Convertor.plain_text_regex.match(text, index)
+            if plain:
+                index = plain.end()
+                text_state.plain_text += plain.group(0)
+                previous_byte = text[index - 1]
+                no_text_output_yet = False
+                beginning_of_paragraph = False
+                continue
 
-                        if p[1] == "version":
-                            # Nothing to do here
-                            pass
-                        elif p[1] == "line break":
-                            message(2, "Line break")
+            matched = None
+            if text[index] == 92:   # backslash
+                matched = Convertor.patterns_regex.match(text, index)
+
+            if matched:
+                command = Convertor.pattern_names[matched.lastindex]
+                arguments = matched.groups()[matched.lastindex:]
+                index = matched.end()
+
+                # First check for commands that won't break a text run
+                if command == "slash":
+                    text_state.plain_text += b"\\"
+                    previous_byte = b"\\"
+                    no_text_output_yet = False
+                    beginning_of_paragraph = False
+                elif command == "comment":
+                    message(2, "Comment: {0}".format(arguments[0]))
+                elif command == "soft hyphen":
+                    message(2, "Soft Hyphen")
+                    text_state.plain_text += b'\xad'
+                    previous_byte = '\u00ad'
+                else:
+                    # Found a command that breaks a run. First finish the previous text run (if any).
+                    self.store_text_run(text_state)
+
+                    if command == "version":
+                        # Nothing to do here
+                        pass
+                    elif command == "line break":
+                        message(2, "Line break")
+                        text_state.prefix_line_breaks += 1
+                        beginning_of_paragraph = True
+                        previous_byte = 10 #b'\n'
+                        message(2, "add one line break. line breaks={0}".format(text_state.prefix_line_breaks))
+                    elif command == "alignment":
+                        text_state.alignment = chr(ord(arguments[0]))
+                        message(2, "alignment type: {0}".format(text_state.alignment))
+                        if not beginning_of_paragraph:
                             text_state.prefix_line_breaks += 1
                             beginning_of_paragraph = True
-                            previous_byte = 10 #b'\n'
-                            message(2, "add one line break. line breaks={0}".format(text_state.prefix_line_breaks))
-                        elif p[1] == "alignment":
-                            text_state.alignment = chr(ord(matched.group(1)))
-                            message(2, "alignment type: {0}".format(text_state.alignment))
-                            if not beginning_of_paragraph:
-                                text_state.prefix_line_breaks += 1
-                                beginning_of_paragraph = True
-                                message(2, "add one line break for the alignment command. line breaks={0} ".format(text_state.prefix_line_breaks))
-                            previous_byte = b'alignment'
-                        elif p[1] == "background":
-                            message(2, "background colour: {0} {1} {2}".format(int(matched.group(1)), int(matched.group(2)), int(matched.group(3))))
-                            # Nothing to do here: background hint colour is only relevant when
-                            # rendering using the FontManager on RISC OS. There is no equivalent
-                            # for SVG.
-                        elif p[1] == "colour":
-                            text_state.text_colour = Convertor.ColourType(int(matched.group(1)), int(matched.group(2)), int(matched.group(3)))
-                            message(2, "text foreground colour: {0} {1} {2}".format(int(matched.group(1)), int(matched.group(2)), int(matched.group(3))))
-                        elif p[1] == "columns":
-                            text_state.num_columns = int(matched.group(1))
-                            message(2, "num columns: {0}".format(text_state.num_columns))
-                        elif p[1] == "font size":
-                            font_index = int(matched.group(1))
-                            text_state.text_area_fonts[font_index] = Convertor.FontDesc(matched.group(2), int(matched.group(3)), int(matched.group(3)), self.font_replacements)
-                            message(2, "font {0}: '{1}' {2}pt".format(int(matched.group(1)), Convertor.latin1_to_utf8(matched.group(2)), int(matched.group(3))))
-                        elif p[1] == "font size width":
-                            font_index = int(matched.group(1))
-                            text_state.text_area_fonts[font_index] = Convertor.FontDesc(matched.group(2), int(matched.group(3)), int(matched.group(4)), self.font_replacements)
-                            message(2, "font {0}: '{1}' {2}pt {3}pt".format(int(matched.group(1)), Convertor.latin1_to_utf8(matched.group(2)), matched.group(3), matched.group(4)))
-                        elif p[1] == "setfont":
-                            text_state.font_index = int(matched.group(1))
-                            message(2, "Set Font {0}".format(text_state.font_index))
-                        elif p[1] == "line leading":
-                            text_state.line_spacing_px = CoordinateConversion.pt_to_px(int(matched.group(1)))
-                            message(2, "Line spacing {0}".format(text_state.line_spacing_px))
-                        elif p[1] == "margins":
-                            text_state.left_margin_px  = CoordinateConversion.pt_to_px(int(matched.group(1)))
-                            text_state.right_margin_px = CoordinateConversion.pt_to_px(int(matched.group(2)))
-                            message(2, "Margins {0} {1}".format(text_state.left_margin_px, text_state.right_margin_px))
-                        elif p[1] == "paragraph leading":
-                            text_state.paragraph_spacing_px = CoordinateConversion.pt_to_px(int(matched.group(1)))
-                            message(2, "Paragraph spacing {0}".format(text_state.paragraph_spacing_px))
-                        elif p[1] == "underline":
-                            text_state.underline_pos = int(matched.group(1))
-                            text_state.underline_thickness = int(matched.group(2))
-                            message(2, "Underline: pos {0} thickness {1}".format(text_state.underline_pos, text_state.underline_thickness))
-                        elif p[1] == "underline end":
-                            text_state.underline_pos = 0
-                            text_state.underline_thickness = 0
-                            message(2, "Underline end")
-                        elif p[1] == "vertical move":
-                            text_state.vertical_move_px += CoordinateConversion.pt_to_px(int(matched.group(1)))
-                            message(2, "Vertical move: pos {0}".format(text_state.vertical_move_px))
-                    break
-
-            # DEBUG:
-            #if is_debug_active():
-            #    print("{0}:{1} ".format(remaining_text_bytes[0], chr(remaining_text_bytes[0])), end="")
+                            message(2, "add one line break for the alignment command. line breaks={0} ".format(text_state.prefix_line_breaks))
+                        previous_byte = b'alignment'
+                    elif command == "background":
+                        message(2, "background colour: {0} {1} {2}".format(int(arguments[0]), int(arguments[1]), int(arguments[2])))
+                        # Nothing to do here: background hint colour is only relevant when
+                        # rendering using the FontManager on RISC OS. There is no equivalent
+                        # for SVG.
+                    elif command == "colour":
+                        text_state.text_colour = Convertor.ColourType(int(arguments[0]), int(arguments[1]), int(arguments[2]))
+                        message(2, "text foreground colour: {0} {1} {2}".format(int(arguments[0]), int(arguments[1]), int(arguments[2])))
+                    elif command == "columns":
+                        text_state.num_columns = int(arguments[0])
+                        message(2, "num columns: {0}".format(text_state.num_columns))
+                    elif command == "font size":
+                        font_index = int(arguments[0])
+                        text_state.text_area_fonts[font_index] = Convertor.FontDesc(arguments[1], int(arguments[2]), int(arguments[2]), self.font_replacements)
+                        message(2, "font {0}: '{1}' {2}pt".format(int(arguments[0]), Convertor.latin1_to_utf8(arguments[1]), int(arguments[2])))
+                    elif command == "font size width":
+                        font_index = int(arguments[0])
+                        text_state.text_area_fonts[font_index] = Convertor.FontDesc(arguments[1], int(arguments[2]), int(arguments[3]), self.font_replacements)
+                        message(2, "font {0}: '{1}' {2}pt {3}pt".format(int(arguments[0]), Convertor.latin1_to_utf8(arguments[1]), arguments[2], arguments[3]))
+                    elif command == "setfont":
+                        text_state.font_index = int(arguments[0])
+                        message(2, "Set Font {0}".format(text_state.font_index))
+                    elif command == "line leading":
+                        text_state.line_spacing_px = CoordinateConversion.pt_to_px(int(arguments[0]))
+                        message(2, "Line spacing {0}".format(text_state.line_spacing_px))
+                    elif command == "margins":
+                        text_state.left_margin_px  = CoordinateConversion.pt_to_px(int(arguments[0]))
+                        text_state.right_margin_px = CoordinateConversion.pt_to_px(int(arguments[1]))
+                        message(2, "Margins {0} {1}".format(text_state.left_margin_px, text_state.right_margin_px))
+                    elif command == "paragraph leading":
+                        text_state.paragraph_spacing_px = CoordinateConversion.pt_to_px(int(arguments[0]))
+                        message(2, "Paragraph spacing {0}".format(text_state.paragraph_spacing_px))
+                    elif command == "underline":
+                        text_state.underline_pos = int(arguments[0])
+                        text_state.underline_thickness = int(arguments[1])
+                        message(2, "Underline: pos {0} thickness {1}".format(text_state.underline_pos, text_state.underline_thickness))
+                    elif command == "underline end":
+                        text_state.underline_pos = 0
+                        text_state.underline_thickness = 0
+                        message(2, "Underline end")
+                    elif command == "vertical move":
+                        text_state.vertical_move_px += CoordinateConversion.pt_to_px(int(arguments[0]))
+                        message(2, "Vertical move: pos {0}".format(text_state.vertical_move_px))
+                continue
 
-            if offset == 1:
-                should_output_char = True
-                keep_previous_byte = None
+            # A single character: a newline, or a backslash that doesn't start an escape sequence
+            current_byte = text[index]
+            should_output_char = True
+            keep_previous_byte = None
+
+            # deal with newlines
+            if current_byte == 10:
+                should_output_char = False
+                if no_text_output_yet:
+                    self.store_text_run(text_state)
+
+                    # insert paragraph break for each newline before the text starts
+                    text_state.prefix_para_breaks += 1
+                    beginning_of_paragraph = True
+                    message(2, "Add paragraph break for newline before any text. para breaks={0}".format(text_state.prefix_para_breaks))
+                else:
+                    # Get next character (and handle being at end of text)
+                    next_byte = None
+                    if index + 1 < len(text):
+                        next_byte = text[index + 1]
 
-                # deal with newlines
-                if remaining_text_bytes[0] == 10:
-                    should_output_char = False
-                    if no_text_output_yet:
+                    if next_byte == 32 or next_byte == 9:
+                        # if newline followed by a space or TAB, then add a paragraph break
                         self.store_text_run(text_state)
+                        if text_state.prefix_line_breaks == 0:
+                            text_state.prefix_line_breaks += 1
+                        text_state.prefix_para_breaks += 1
+                        beginning_of_paragraph = True
+                        message(2, "Add line and para break for newline followed by space or TAB. para breaks={0} line breaks={1}".format(text_state.prefix_para_breaks, text_state.prefix_line_breaks))
+                    elif previous_byte == 10:
+                        # Two newlines gives a paragraph break
+                        self.store_text_run(text_state)
+                        if text_state.prefix_line_breaks == 0:
+                            text_state.prefix_line_breaks += 1
+                            keep_previous_byte = 10
+                        text_state.prefix_para_breaks += 1
+                        beginning_of_paragraph = True
+                        message(2, "Add line and para break for newline-newline. para breaks={0} line breaks={1}".format(text_state.prefix_para_breaks, text_state.prefix_line_breaks))
+                        current_byte = 32
 
-                        # insert paragraph break for each newline before the text starts
+                    elif previous_byte == b'alignment':
                         text_state.prefix_para_breaks += 1
                         beginning_of_paragraph = True
-                        message(2, "Add paragraph break for newline before any text. para breaks={0}".format(text_state.prefix_para_breaks))
+                        message(2, "Add para break for alignment-newline. para breaks={0}".format(text_state.prefix_para_breaks))
+                        current_byte = 32
+                    elif previous_byte == 32 or previous_byte == 9:
+                        # if previous character was a space or tab, ignore the newline
+                        pass
                     else:
-                        # Get next character (and handle being at end of text)
-                        next_byte = None
-                        if len(remaining_text_bytes)>1:
-                            next_byte = remaining_text_bytes[1]
-
-                        if next_byte == 32 or next_byte == 9:
-                            # if newline followed by a space or TAB, then add a paragraph break
-                            self.store_text_run(text_state)
-                            if text_state.prefix_line_breaks == 0:
-                                text_state.prefix_line_breaks += 1
-                            text_state.prefix_para_breaks += 1
-                            beginning_of_paragraph = True
-                            message(2, "Add line and para break for newline followed by space or TAB. para breaks={0} line breaks={1}".format(text_state.prefix_para_breaks, text_state.prefix_line_breaks))
-                        elif previous_byte == 10:
-                            # Two newlines gives a paragraph break
-                            self.store_text_run(text_state)
-                            if text_state.prefix_line_breaks == 0:
-                                text_state.prefix_line_breaks += 1
-                                keep_previous_byte = 10
-                            text_state.prefix_para_breaks += 1
-                            beginning_of_paragraph = True
-                            message(2, "Add line and para break for newline-newline. para breaks={0} line breaks={1}".format(text_state.prefix_para_breaks, text_state.prefix_line_breaks))
-                            remaining_text_bytes = bytearray(b' ') + remaining_text_bytes[1:]
+                        if next_byte != 10:
+                            # replace single newline with space
+                            message(2, "replace {0} with space. Previous byte {1}".format(next_byte, previous_byte))
+                            current_byte = 32
+                            should_output_char = True
+
+            if keep_previous_byte:
+                previous_byte = keep_previous_byte
+            else:
+                previous_byte = current_byte
 
-                        elif previous_byte == b'alignment':
-                            text_state.prefix_para_breaks += 1
-                            beginning_of_paragraph = True
-                            message(2, "Add para break for alignment-newline. para breaks={0}".format(text_state.prefix_para_breaks))
-                            remaining_text_bytes = bytearray(b' ') + remaining_text_bytes[1:]
-                        elif previous_byte == 32 or previous_byte == 9:
-                            # if previous character was a space or tab, ignore the newline
-                            pass
-                        else:
-                            if next_byte != 10:
-                                # replace single newline with space
-                                message(2, "replace {0} with space. Previous byte {1}".format(next_byte, previous_byte))
-                                remaining_text_bytes = bytearray(b' ') + remaining_text_bytes[1:]
-                                should_output_char = True
-
-                if keep_previous_byte:
-                    previous_byte = keep_previous_byte
-                else:
-                    previous_byte = remaining_text_bytes[0]
-
-                if should_output_char:
-                    # Control characters are ignored, except for tab, which is replaced by a space.
-                    c = remaining_text_bytes[0]
-                    if c >= 32:
-                        text_state.plain_text.append(remaining_text_bytes[0])
-                        no_text_output_yet = False
-                        beginning_of_paragraph = False
-                    elif c == 9:
-                        text_state.plain_text.append(b" ")
-                        no_text_output_yet = False
-                        beginning_of_paragraph = False
-
-            remaining_text_bytes = remaining_text_bytes[offset:]
+            if should_output_char:
+                text_state.plain_text.append(current_byte)
+                no_text_output_yet = False
+                beginning_of_paragraph = False
+
+            index += 1
 
         # Finish any final text run
         self.store_text_run(text_state)
@@ -3696,7 +5303,7 @@ class Convertor:
             run.message(2)
 
         # Start with all runs
-        remaining_text_runs = self.text_runs
+        remaining_text_runs = collections.deque(self.text_runs)
         is_first_line = True
 
         # Width of the text column
@@ -3759,10 +5366,8 @@ class Convertor:
                 if (len(line_text_runs) > 0) and end_of_paragraph:
                     last_line_of_paragraph = True
                     break
-                line_text_runs.append(remaining_text_runs[0])
-                remaining_text_runs = remaining_text_runs[1:]
+                line_text_runs.append(remaining_text_runs.popleft())
                 previous_width = current_width
-                line_text_runs[-1].measure()
                 current_width += line_text_runs[-1].text_state.length
 
             final_run = line_text_runs[-1]
@@ -3773,50 +5378,38 @@ class Convertor:
                 # we reach one character. Draw at least that.
 
                 # make a copy of the final run
-                test_run = copy.deepcopy(final_run)
+                test_run = Convertor.TextRun(final_run.text_state)
                 test_run.text_state.prefix_line_breaks = 0
                 test_run.text_state.prefix_para_breaks = 0
-                full_text = final_run.text_state.plain_text
 
                 number_of_spaces_on_current_line = 0
                 for run in line_text_runs[:-1]:
                     number_of_spaces_on_current_line += run.text_state.plain_text.count(' ')
-                    #print("PLN TEXT:'{0}'".format(run.text_state.plain_text))
-                #print("SPACES:", number_of_spaces_on_current_line)
-
-                while (current_width > text_area_width) and (len(test_run.text_state.plain_text) > 1):
-                    # TODO: Handle leading spaces / soft hyphens
-                    last_space = test_run.text_state.plain_text.rfind(' ')
-                    last_soft_hyphen = test_run.text_state.plain_text.rfind('\u00ad')
-                    if (last_soft_hyphen > 0) and (last_soft_hyphen > last_space):
-                        # Try chopping off at the final soft hyphen (adding an actual hyphen instead)
-                        test_run.text_state.plain_text = test_run.text_state.plain_text[0:last_soft_hyphen] + "-"
-                    elif last_space > 0:
-                        # Chop off the final word
-                        test_run.text_state.plain_text = test_run.text_state.plain_text[0:last_space]
-                    elif len(test_run.text_state.plain_text) > 1:
-                        if number_of_spaces_on_current_line == 0:
-                            # if there is only one word on the current line, chop off a character
-                            # at a time.
-                            test_run.text_state.plain_text = test_run.text_state.plain_text[0:-1]
-                        else:
-                            # not one word of this run fits on the current line.
-                            test_run.text_state.plain_text = ""
-                            test_run.measure()
-                            current_width = previous_width + test_run.text_state.length
 
-                            # strip any final space
-                            line_text_runs[-1].text_state.plain_text = line_text_runs[-1].text_state.plain_text.rstrip()
-                            line_text_runs[-1].measure()
-                            break
-
-                    # Re-measure the shorter text
+                # The line breaker measures the run's text once, for this line and those after
+                if final_run.line_breaker == None:
+                    final_run.line_breaker = Convertor.LineBreaker(final_run.text_state)
+                    final_run.line_breaker_start = 0
+                line_breaker = final_run.line_breaker
+                start = final_run.line_breaker_start
+                cut = line_breaker.find_break(start, previous_width, text_area_width, number_of_spaces_on_current_line)
+
+                if cut != None:
+                    (end, hyphen) = cut
+                    test_run.text_state.plain_text = line_breaker.text[start:end] + ("-" if hyphen else "")
+                    test_run.text_state.set_length(line_breaker.length(start, end, hyphen))
+                    current_width = previous_width + test_run.text_state.length
+                else:
+                    # not one word of this run fits on the current line.
+                    test_run.text_state.plain_text = ""
                     test_run.measure()
-                    #print("new measure=", test_run.text_state.length, "for text:", test_run.text_state.plain_text)
-
-                    # Get the current width now we have measured the final run
                     current_width = previous_width + test_run.text_state.length
 
+                    # strip any final space
+                    line_text_runs[-1].text_state.plain_text = line_text_runs[-1].text_state.plain_text.rstrip()
+                    line_text_runs[-1].measure()
+                    line_text_runs[-1].line_breaker = None
+
                 # Now we know how much text fits on the line, we split the final run into two parts
                 # (1) The part that fits on the current line, and (2) the remaining text that doesn't.
 
@@ -3829,8 +5422,12 @@ class Convertor:
                 new_run.text_state.plain_text = new_run.text_state.plain_text[start:].lstrip()
                 if (len(new_run.text_state.plain_text) > 0):
                     new_run.vertical_move_px = 0
-                    new_run.measure()
-                    remaining_text_runs.insert(0, new_run)
+                    if new_run.line_breaker != None:
+                        new_run.line_breaker_start = len(new_run.line_breaker.text) - len(new_run.text_state.plain_text)
+                        new_run.text_state.set_length(new_run.line_breaker.length(new_run.line_breaker_start, len(new_run.line_breaker.text)))
+                    else:
+                        new_run.measure()
+                    remaining_text_runs.appendleft(new_run)
 
                 # (1) The part that fits on the current line.
                 line_text_runs[-1] = copy.copy(test_run)
@@ -4134,6 +5731,17 @@ class Convertor:
                 else:
                     message(2, " Object type: {0}, (index={1})".format(object_header.obj_type, debug_index))
 
+                # Only paths can be added to a path that is still open
+                if object_header.obj_type != Convertor.OBJECT_PATH:
+                    self.end_pending_path(fout)
+
+                # Paths (and groups, that may hold paths) are written in Draw units, other
+                # objects in SVG coordinates
+                if object_header.obj_type in (Convertor.OBJECT_PATH, Convertor.OBJECT_GROUP, Convertor.OBJECT_TAGGED):
+                    self.end_svg_units(fout)
+                elif object_header.obj_type not in (Convertor.OBJECT_OPTIONS, Convertor.OBJECT_FONTTABLE):
+                    self.begin_svg_units(fout)
+
                 if object_header.obj_type == Convertor.OBJECT_OPTIONS:
                     self.read_options_object(fin, fout, object_header)
                 elif object_header.obj_type == Convertor.OBJECT_FONTTABLE:
@@ -4165,6 +5773,9 @@ class Convertor:
                     top_right   = self.cc.draw_to_svg_point(object_header.high)
                     fout.write('<rect x="{0}" y="{1}" width="{2}" height="{3}" stroke="none" fill="#a0a0a080" />\n'.format(bottom_left.x, top_right.y, top_right.x - bottom_left.x, bottom_left.y - top_right.y))
 
+                if self.config.show_bounding_boxes or self.config.show_debug_index:
+                    self.begin_svg_units(fout)
+
                 # Show bounding box on top of object
                 if self.config.show_bounding_boxes:
                     # Show object bounding boxes
@@ -4191,6 +5802,23 @@ class Convertor:
             if (length != -1) and fin.tell()>=(saveptr+length):
                 break
 
+        if fout != None:
+            self.end_pending_path(fout)
+            self.end_svg_units(fout)
+
+    def begin_svg_units(self, fout):
+        """When paths are written in Draw units, starts a group undoing the transform to Draw
+        units, for objects that are written in SVG coordinates"""
+        if self.config.draw_units and not self.in_svg_units:
+            fout.write('<g transform="{0}">\n'.format(self.path_cc.svg_to_draw_transform))
+            self.in_svg_units = True
+
+    def end_svg_units(self, fout):
+        """Finish any group started by begin_svg_units()"""
+        if self.in_svg_units:
+            fout.write('</g>\n')
+            self.in_svg_units = False
+
     def add_entry(self, result, text):
         if len(result) > 0:
             result += ','
@@ -4222,9 +5850,55 @@ class Convertor:
         result = self.add_entry(result, entry)
         return result
 
+    @contextlib.contextmanager
+    def map_input_file(self, fin):
+        # Map the input file into memory, so large embedded images can be read without copying
+        file_map = None
+        self.file_view = None
+        try:
+            file_map = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+            self.file_view = memoryview(file_map)
+        except (OSError, ValueError):
+            # e.g. an empty file, or a file system that doesn't support mapping
+            pass
+
+        try:
+            yield
+        finally:
+            # Views must be released before the map can be closed
+            if self.file_view != None:
+                self.file_view.release()
+                self.file_view = None
+            if file_map != None:
+                try:
+                    file_map.close()
+                except BufferError:
+                    # A view is still held (e.g. by an exception's traceback). The map is
+                    # closed once that is garbage collected.
+                    pass
+
     def convert_to_svg(self, infile, outfile = None):
         self.cap_count = 0
         self.path_count = 0
+        self.image_count = 0
+        self.image_bytes = 0
+        self.image_encode_time = 0
+        self.jpeg_count = 0
+        self.jpeg_defs = {}
+        self.jpeg_images = {}
+        self.cap_defs = {}
+        self.marker_defs = {}
+        self.pending_path = None        # (attributes, bounding box) of a <path> that is still open
+        self.coalesced_paths = 0
+        self.path_points = 0
+        self.path_points_removed = 0
+        self.in_svg_units = False       # True while in a group for objects in SVG coordinates
+
+        # Fall back to PNG if this Pillow can't write WebP
+        self.image_format = self.config.image_format
+        if self.image_format != "png" and not features.check("webp"):
+            warning("WebP is not supported by this installation of Pillow, using PNG instead")
+            self.image_format = "png"
 
         global debug_index
         debug_index = 0
@@ -4251,7 +5925,7 @@ class Convertor:
 
         file_header = Convertor.FileHeader()
 
-        with open(infile, 'rb') as fin:
+        with open(infile, 'rb') as fin, self.map_input_file(fin):
             fin.seek(0, 2)              # move to end of file
             self.file_size = fin.tell() # get file size
             fin.seek(0, 0)              # move to start of file
@@ -4316,6 +5990,15 @@ class Convertor:
             # Initialise coordinate conversion object
             self.cc = CoordinateConversion(size_in_draw_units[0], size_in_draw_units[1], size_in_pixels[0], size_in_pixels[1])
 
+            # Paths are either converted to SVG coordinates like everything else, or written in
+            # Draw units (which are integers) inside one transform to SVG coordinates
+            if self.config.draw_units:
+                self.path_cc = DrawUnitConversion(self.cc)
+                self.path_dp = self.path_cc.dp
+            else:
+                self.path_cc = self.cc
+                self.path_dp = self.dp
+
             # Pass 2: Parse all objects and write out the results
             with open(outfile, 'w') as fout:
 
@@ -4358,18 +6041,36 @@ class Convertor:
                 #fout.write('@import url("https://fonts.googleapis.com/css?family=VT323");')
                 #fout.write("</style>")
 
+                if self.config.draw_units:
+                    fout.write('<g transform="{0}">\n'.format(self.path_cc.draw_to_svg_transform))
+
                 self.read_objects(fin, fout, -1)
 
+                if self.config.draw_units:
+                    fout.write('</g>\n')
+
                 if convertor.config.show_bounding_boxes:
                     # Show file's bounding border in green
                     fout.write('<rect x="{0}" y="{1}" width="{2}" height="{3}" stroke="#00ff00" fill="none" />\n'.format(bottom_left.x, top_right.y, top_right.x - bottom_left.x, bottom_left.y - top_right.y))
 
                 fout.write('</svg>')
 
+        message(2, "Images: {0}, {1} bytes embedded, {2:.3f} seconds encoding".format(self.image_count, self.image_bytes, self.image_encode_time))
+        message(2, "Paths: {0}, {1} coalesced into the path before".format(self.path_count, self.coalesced_paths))
+        message(2, "Fonts: {0} loaded, {1} reused (since the program started)".format(font_cache.misses, font_cache.hits))
+        if self.config.simplify_tolerance != None:
+            message(1, "Simplifying paths removed {0} of {1} points".format(self.path_points_removed, self.path_points))
         return True
 
 convertor = Convertor()
 
+def positive_float(text):
+    # Argument type for options that must be greater than zero
+    value = float(text)
+    if not value > 0:
+        raise argparse.ArgumentTypeError("must be greater than zero: '{0}'".format(text))
+    return value
+
 class MyParser(argparse.ArgumentParser):
     def error(self, message):
         sys.stderr.write('error: %s\n' % message)
@@ -4395,6 +6096,25 @@ options:
   -f   --fonts <ini-file>     fonts ini file listing the replacement font stacks
   -b   --fit-border <amount>  Set SVG page size to match Draw content with a border amount in pixels or percentage (e.g. '50px' or '20%')
   -1   --one-byte-types       Some applications use a one byte object type, as opposed to the default two byte value
+       --no-crop-sprites      don't crop away the fully transparent border of sprites before encoding them
+       --sprite-tile-rows <n> output sprites taller than <n> rows as bands of <n> rows each, to bound memory use (default 0, never)
+       --image-format <fmt>   format for embedded images: 'png' (default), 'webp-lossless' (sprites only) or 'webp' (lossy where smaller, JPEGs too)
+       --image-quality <q>    quality of lossy WebP and resampled JPEG images from 0 to 100 (default 80)
+       --max-dpi <dpi>        resample embedded images that would be displayed at more than <dpi> dots per inch
+       --strip-jpeg-metadata  remove metadata (EXIF, XMP, comments, etc.) from embedded JPEGs, without recompressing them
+       --no-dedupe-jpegs      embed every JPEG object's data separately, even when identical
+       --flatness <px>        how closely straight lines follow curves when placing line caps, in pixels (default 0.02)
+       --cap-placement <how>  'flatten' (default) places line caps along a straight line approximation of curves, 'arc-length' measures the curves exactly
+       --cap-output <how>     'elements' (default) writes a complete element for each line cap, 'symbols' defines each cap shape once and reuses it, 'compound' writes all the caps of a path as one element
+       --cap-markers          use SVG markers for the line caps of undashed paths
+       --compact-paths        write path data with relative coordinates where shorter, and no redundant characters
+       --path-precision <n>   number of decimal places in compact path data (default 4)
+       --coalesce-paths       write runs of consecutive paths with the same style and no line caps as a single SVG path
+       --simplify <px>        remove duplicate points from paths, and points of straight lines while staying within <px> pixels (0 for only collinear points)
+       --draw-units           write paths in whole Draw units inside a single transform, rather than converting every coordinate to pixels
+       --no-font-index        search the font directories for each font used to measure text, rather than using a saved index of them
+       --font-family-names    also find fonts used to measure text ignoring case and by family name (e.g. 'DejaVu Sans'), using the saved index
+       --check-text-measurement  warn if text measured from cached character widths and kerning differs from measuring the whole text
 
 For debugging the tool:
   -l   --label-debug          add debugging labels to each object
@@ -4420,6 +6140,25 @@ if __name__ == '__main__':
     parser.add_argument('-f', '--fonts',            help="fonts ini file listing the replacement font stacks", metavar="<ini-file>")
     parser.add_argument('-1', '--one-byte-types',   help="Some applications use a one byte object type, as opposed to the default two byte value", action=argparse.BooleanOptionalAction, default=False)
     parser.add_argument('-b', '--fit-border',       help="fit page size to match SVG with a border amount in pixels or percentage (e.g. '50px' or '20%%')", metavar="<border-amount>")
+    parser.add_argument('--crop-sprites',           help="crop the fully transparent border of sprites before encoding them", action=argparse.BooleanOptionalAction, default=True)
+    parser.add_argument('--sprite-tile-rows',       help="output sprites taller than <n> rows as bands of <n> rows each, to bound memory use", metavar="<n>", type=int, default=0)
+    parser.add_argument('--image-format',           help="format for embedded images", choices=["png", "webp-lossless", "webp"], default="png")
+    parser.add_argument('--image-quality',          help="quality of lossy WebP and resampled JPEG images from 0 to 100", metavar="<q>", type=int, default=80)
+    parser.add_argument('--max-dpi',                help="resample embedded images that would be displayed at more than <dpi> dots per inch", metavar="<dpi>", type=float)
+    parser.add_argument('--strip-jpeg-metadata',    help="remove metadata (EXIF, XMP, comments, etc.) from embedded JPEGs, without recompressing them", action=argparse.BooleanOptionalAction, default=False)
+    parser.add_argument('--dedupe-jpegs',           help="embed identical JPEG data only once", action=argparse.BooleanOptionalAction, default=True)
+    parser.add_argument('--flatness',               help="how closely straight lines follow curves when placing line caps, in pixels", metavar="<px>", type=positive_float, default=0.02)
+    parser.add_argument('--cap-placement',          help="how to find where line caps go along curves", choices=["flatten", "arc-length"], default="flatten")
+    parser.add_argument('--cap-output',             help="how to write line caps", choices=["elements", "symbols", "compound"], default="elements")
+    parser.add_argument('--cap-markers',            help="use SVG markers for the line caps of undashed paths", action=argparse.BooleanOptionalAction, default=False)
+    parser.add_argument('--compact-paths',          help="write path data with relative coordinates where shorter, and no redundant characters", action=argparse.BooleanOptionalAction, default=False)
+    parser.add_argument('--path-precision',         help="number of decimal places in compact path data", metavar="<n>", type=int, default=4)
+    parser.add_argument('--coalesce-paths',         help="write runs of consecutive paths with the same style and no line caps as a single SVG path", action=argparse.BooleanOptionalAction, default=False)
+    parser.add_argument('--simplify',               help="remove duplicate points from paths, and points of straight lines while staying within <px> pixels", metavar="<px>", type=float)
+    parser.add_argument('--draw-units',             help="write paths in whole Draw units inside a single transform, rather than converting every coordinate to pixels", action=argparse.BooleanOptionalAction, default=False)
+    parser.add_argument('--font-index',             help="find fonts used to measure text from a saved index of the font directories", action=argparse.BooleanOptionalAction, default=True)
+    parser.add_argument('--font-family-names',      help="also find fonts used to measure text ignoring case and by family name, using the saved index", action=argparse.BooleanOptionalAction, default=False)
+    parser.add_argument('--check-text-measurement', help="warn if text measured from cached character widths and kerning differs from measuring the whole text", action=argparse.BooleanOptionalAction, default=False)
 
     if len(sys.argv)==1:
         parser.print_help(sys.stderr)
@@ -4437,6 +6176,25 @@ if __name__ == '__main__':
     convertor.config.fonts_ini           = args.fonts
     convertor.config.fit_border          = args.fit_border
     convertor.config.one_byte_types      = args.one_byte_types
+    convertor.config.crop_sprites        = args.crop_sprites
+    convertor.config.sprite_tile_rows    = args.sprite_tile_rows
+    convertor.config.image_format        = args.image_format
+    convertor.config.image_quality       = args.image_quality
+    convertor.config.max_dpi             = args.max_dpi
+    convertor.config.strip_jpeg_metadata = args.strip_jpeg_metadata
+    convertor.config.dedupe_jpegs        = args.dedupe_jpegs
+    convertor.config.flatness_tolerance  = args.flatness
+    convertor.config.cap_placement       = args.cap_placement
+    convertor.config.cap_output          = args.cap_output
+    convertor.config.cap_markers         = args.cap_markers
+    convertor.config.compact_paths       = args.compact_paths
+    convertor.config.path_precision      = args.path_precision
+    convertor.config.coalesce_paths      = args.coalesce_paths
+    convertor.config.simplify_tolerance  = args.simplify
+    convertor.config.draw_units          = args.draw_units
+    convertor.config.font_index          = args.font_index
+    convertor.config.font_family_names   = args.font_family_names
+    convertor.config.check_text_measurement = args.check_text_measurement
 
     if (args.input != None) and (args.output != None):
         if args.input == args.output: